@@ -7,6 +7,7 @@
 # In[ ]:
 
 import numpy as np
+from contextlib import nullcontext
 import chainer
 from chainer import cuda, Function, gradient_check, report, training, utils, Variable
 from chainer import datasets, iterators, optimizers, serializers
@@ -29,11 +30,20 @@ class EncoderDecoder(Chain):
 
     def __init__(self, vsize_enc, vsize_dec,
                  nlayers_enc, nlayers_dec, nlayers_highway,
-                 n_units, gpuid, segment_size=None, n_filters=None, attn=False, convolutional=False):
+                 n_units, gpuid, segment_size=None, n_filters=None, attn=False, convolutional=False,
+                 recompute_chunk=0, attn_score="dot", sampling_ratio=0.):
         '''
         vsize:   vocabulary size
         nlayers: # layers
         attn:    if True, use attention
+        attn_score: attention scoring, "dot", "general" (bilinear) or
+                    "additive" (Bahdanau)
+        recompute_chunk: if > 0, batch training keeps activations only at the
+                         boundaries of chunks of this many timesteps and
+                         recomputes the rest during backward
+        sampling_ratio: scheduled sampling, the probability that a training
+                        step feeds the decoder its own previous prediction
+                        instead of the gold token (0 is teacher forcing)
         '''
         super(EncoderDecoder, self).__init__()
         #--------------------------------------------------------------------
@@ -92,7 +102,17 @@ class EncoderDecoder(Chain):
         if attn > 0:
             # add context layer for attention
             self.add_link("context", L.Linear(4*n_units, 2*n_units))
+            # scoring layers, the encoder side is projected once per batch
+            if attn_score == "general":
+                self.add_link("attn_general", L.Linear(2*n_units, 2*n_units, nobias=True))
+            elif attn_score == "additive":
+                self.add_link("attn_enc", L.Linear(2*n_units, 2*n_units, nobias=True))
+                self.add_link("attn_dec", L.Linear(2*n_units, 2*n_units))
+                self.add_link("attn_v", L.Linear(2*n_units, 1, nobias=True))
+            elif attn_score != "dot":
+                raise ValueError("unknown attention score: {0:s}".format(attn_score))
         self.attn = attn
+        self.attn_score = attn_score
 
         # add output layer
         self.add_link("out", L.Linear(2*n_units, vsize_dec))
@@ -103,6 +123,16 @@ class EncoderDecoder(Chain):
         self.convolutional = convolutional
         self.segment_size = segment_size
         self.n_filters = n_filters
+        # optional nmt_profile.PhaseProfiler for timing the forward pass
+        self.profiler = None
+        if recompute_chunk > 0 and not hasattr(F, "forget"):
+            raise RuntimeError("recompute_chunk needs chainer.functions.forget, "
+                               "which this chainer version does not have")
+        self.recompute_chunk = recompute_chunk
+        self.sampling_ratio = sampling_ratio
+        # layer name -> (weights, row scales or None, bias or None), filled by
+        # compress_for_inference
+        self.compressed = {}
 
         xp = cuda.cupy if self.gpuid >= 0 else np
 
@@ -113,6 +143,12 @@ class EncoderDecoder(Chain):
         # this way loss will not be computed for this predicted loss
         self.mask_pad_id[0] = 0
 
+    def phase(self, name):
+        # time a section of the forward pass if a profiler is attached
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.phase(name)
+
     def reset_state(self):
         # reset the state of LSTM layers
         for lstm_name in self.lstm_enc + self.lstm_rev_enc + self.lstm_dec:
@@ -129,6 +165,131 @@ class EncoderDecoder(Chain):
         # h_state = F.split((self.enc_states), [:len(self.enc_states.data)])[0]
         self[self.lstm_dec[0]].set_state(c_state, h_state)
 
+    def lstm_states(self, lstm_layer_list):
+        # flat list of cell and hidden states of the given LSTM layers
+        states = []
+        for lstm_name in lstm_layer_list:
+            states += [self[lstm_name].c, self[lstm_name].h]
+        return states
+
+    def set_lstm_states(self, lstm_layer_list, states):
+        for k, lstm_name in enumerate(lstm_layer_list):
+            self[lstm_name].set_state(states[2*k], states[2*k+1])
+
+    def init_lstm_states(self, lstm_layer_list, batch_size):
+        # zero states behave like a fresh LSTM, but can be passed around
+        xp = cuda.cupy if self.gpuid >= 0 else np
+        for lstm_name in lstm_layer_list:
+            if self[lstm_name].h is None:
+                zeros = xp.zeros((batch_size, self[lstm_name].state_size), dtype=xp.float32)
+                self[lstm_name].set_state(Variable(zeros), Variable(zeros))
+
+    def recompute(self, func, *xs):
+        '''
+        Run func(*xs) without keeping its intermediate activations, they are
+        recomputed from xs during backward. The numpy RNG state is replayed
+        for the recomputation, so that dropout masks match the forward pass.
+        '''
+        rng_state = np.random.get_state()
+        calls = [0]
+
+        def replay(*args):
+            calls[0] += 1
+            if calls[0] == 1:
+                return func(*args)
+            outer_state = np.random.get_state()
+            np.random.set_state(rng_state)
+            try:
+                return func(*args)
+            finally:
+                np.random.set_state(outer_state)
+
+        return F.forget(replay, *xs)
+
+    #--------------------------------------------------------------------
+    # Reduced precision storage for inference
+    #--------------------------------------------------------------------
+    def compress_for_inference(self, dtype="float16"):
+        '''
+        Store the embeddings and the output layer as float16, or as int8 with
+        one float32 scale per row. Rows are upcast to float32 only when they
+        are used. The model cannot be trained or saved afterwards.
+        '''
+        xp = cuda.cupy if self.gpuid >= 0 else np
+        for name in ["embed_enc", "embed_dec", "out"]:
+            W = self[name].W.data
+            if dtype == "float16":
+                W_c, scale = W.astype(xp.float16), None
+            elif dtype == "int8":
+                scale = xp.abs(W).max(axis=1) / 127.
+                scale[scale == 0] = 1.
+                W_c = xp.rint(W / scale[:, None]).astype(xp.int8)
+                scale = scale.astype(xp.float32)
+            else:
+                raise ValueError("unknown inference dtype: {0:s}".format(dtype))
+            b = self[name].b.data if name == "out" else None
+            self.compressed[name] = (W_c, scale, b)
+            # drop the float32 copy
+            self[name].W.data = xp.empty((0, W.shape[1]), dtype=xp.float32)
+
+    def decompress_rows(self, name, start=None, end=None, ids=None):
+        xp = cuda.cupy if self.gpuid >= 0 else np
+        W_c, scale, _ = self.compressed[name]
+        if ids is not None:
+            rows = W_c[ids].astype(xp.float32)
+            if scale is not None:
+                rows *= scale[ids][..., None]
+        else:
+            rows = W_c[start:end].astype(xp.float32)
+            if scale is not None:
+                rows *= scale[start:end, None]
+        return rows
+
+    def embed(self, embed_layer, word):
+        if embed_layer.name not in self.compressed:
+            return embed_layer(word)
+        return Variable(self.decompress_rows(embed_layer.name, ids=word.data), volatile=True)
+
+    def shortlist_out(self, shortlist):
+        # output layer rows of the shortlisted target ids, gathered once per
+        # decode and passed to every project_out step
+        xp = cuda.cupy if self.gpuid >= 0 else np
+        ids = xp.asarray(shortlist)
+        if "out" in self.compressed:
+            W_sub = self.decompress_rows("out", ids=ids)
+            b_sub = self.compressed["out"][2][ids]
+        else:
+            W_sub = self.out.W.data[ids]
+            b_sub = self.out.b.data[ids]
+        return Variable(W_sub, volatile=True), Variable(b_sub, volatile=True)
+
+    def project_out(self, h, out_rows=None, block_size=8192):
+        '''
+        out_rows: if given, the (W, b) rows from shortlist_out, only those
+                  target ids are scored, in the order of the shortlist
+        '''
+        if out_rows is not None:
+            return F.linear(h, *out_rows)
+        if "out" not in self.compressed:
+            return self.out(h)
+        # upcast a block of output rows at a time to bound the extra memory
+        xp = cuda.cupy if self.gpuid >= 0 else np
+        W_c, _, b = self.compressed["out"]
+        vsize = W_c.shape[0]
+        y = xp.empty((h.shape[0], vsize), dtype=xp.float32)
+        for start in range(0, vsize, block_size):
+            end = min(start + block_size, vsize)
+            y[:, start:end] = h.data.dot(self.decompress_rows("out", start, end).T)
+        y += b
+        return Variable(y, volatile=True)
+
+    def nbytes(self):
+        # memory held by the parameters, including compressed copies
+        total = sum(param.data.nbytes for param in self.params())
+        for W_c, scale, _ in self.compressed.values():
+            total += W_c.nbytes + (scale.nbytes if scale is not None else 0)
+        return total
+
     '''
     Function to feed an input word through the embedding and lstm layers
         args:
@@ -140,7 +301,7 @@ class EncoderDecoder(Chain):
             hs = self[lstm_layer_list[0]](word)
         else:
             # get embedding
-            embed_id = embed_layer(word)
+            embed_id = self.embed(embed_layer, word)
             # feed into first LSTM layer
             hs = self[lstm_layer_list[0]](embed_id)
         # feed into remaining LSTM layers
@@ -158,7 +319,7 @@ class EncoderDecoder(Chain):
 
     def convolution_embed(self, in_word_list, train=True):
         ## convolution has 4 dimensions: batches, channels, h and w
-        f_sent_enc = self.embed_enc(in_word_list)
+        f_sent_enc = self.embed(self.embed_enc, in_word_list)
         x,y,z = f_sent_enc.data.shape
         f_sent_enc = F.reshape(f_sent_enc, (x, 1, y, z))
         conv_sent = self[self.conv_enc[0]](f_sent_enc)
@@ -210,8 +371,9 @@ class EncoderDecoder(Chain):
 
         if self.convolutional:
             var_en = F.transpose(var_en)
-            var_en = self.convolution_embed(var_en)
-            var_rev_en = F.fliplr(var_en)
+            # (1, segments, filters) -> one timestep per segment
+            var_en = F.swapaxes(self.convolution_embed(var_en), 0, 1)
+            var_rev_en = F.flipud(var_en)
 
 
         # encode tokens
@@ -228,32 +390,90 @@ class EncoderDecoder(Chain):
                 first_entry = False
 
         self.enc_states = F.concat((forward_states, backward_states), axis=1)
+        if self.attn:
+            self.precompute_attention(train=train)
 
-    def compute_context_vector(self, batches=True):
+    #--------------------------------------------------------------------
+    # Attention
+    #--------------------------------------------------------------------
+    def precompute_attention(self, mask=None, train=True):
+        '''
+        Decoder independent part of the attention, computed once after
+        encoding: the keys scored against the decoder state, the transposed
+        encoder states for the context vector and, for padded batches, an
+        additive bias of -1000 at padded positions (mask is False).
+        '''
         xp = cuda.cupy if self.gpuid >= 0 else np
+        enc_states = self.enc_states
+        if self.attn_score == "dot":
+            self.attn_keys = enc_states
+        else:
+            layer = self.attn_general if self.attn_score == "general" else self.attn_enc
+            if enc_states.data.ndim == 3:
+                batch_size, seq_len, units = enc_states.shape
+                flat = F.reshape(enc_states, (batch_size * seq_len, units))
+                self.attn_keys = F.reshape(layer(flat), (batch_size, seq_len, units))
+            else:
+                self.attn_keys = layer(enc_states)
+        self.attn_values = F.swapaxes(enc_states, 1, 2) if enc_states.data.ndim == 3 else enc_states
+        self.attn_bias = None
+        if mask is not None:
+            self.attn_bias = Variable(xp.where(mask, 0., -1000.).astype(xp.float32),
+                                      volatile=not train)
 
-        batch_size, n_units = self[self.lstm_dec[-1]].h.shape
-        # attention weights for the hidden states of each word in the input list
+    def attention_inputs(self):
+        # attention variables derived from enc_states, see decode_steps_chunked
+        return (self.enc_states, self.attn_keys, self.attn_values)
 
-        if batches:
-            # masking pad ids for attention
-            weights = F.batch_matmul(self.enc_states, self[self.lstm_dec[-1]].h)
-            weights = F.where(self.mask, weights, self.minf)
+    def set_attention_inputs(self, inputs):
+        self.enc_states, self.attn_keys, self.attn_values = inputs
 
-            alphas = F.softmax(weights)
+    def select_rows(self, rows):
+        '''
+        Keep only the given batch rows of the decoder LSTM states and of the
+        encoder states and attention variables, to decode a shrinking batch.
+        '''
+        def take(var):
+            return None if var is None else Variable(var.data[rows], volatile=True)
+        self.set_lstm_states(self.lstm_dec, [take(v) for v in self.lstm_states(self.lstm_dec)])
+        enc_states = take(self.enc_states)
+        if self.attn:
+            keys = enc_states if self.attn_score == "dot" else take(self.attn_keys)
+            self.set_attention_inputs((enc_states, keys, take(self.attn_values)))
+            self.attn_bias = take(self.attn_bias)
+        else:
+            self.enc_states = enc_states
+
+    def attention_scores(self, h):
+        keys = self.attn_keys
+        if keys.data.ndim == 2:
+            # single sentence: (seq, units) keys, (1, units) decoder state
+            if self.attn_score == "additive":
+                e = F.tanh(keys + F.broadcast_to(self.attn_dec(h), keys.shape))
+                return F.reshape(self.attn_v(e), (1, keys.shape[0]))
+            return F.matmul(h, keys, transb=True)
+
+        batch_size, seq_len, units = keys.shape
+        if self.attn_score == "additive":
+            query = F.broadcast_to(F.expand_dims(self.attn_dec(h), 1), keys.shape)
+            e = F.reshape(F.tanh(keys + query), (batch_size * seq_len, units))
+            scores = F.reshape(self.attn_v(e), (batch_size, seq_len))
+        else:
+            scores = F.reshape(F.batch_matmul(keys, h), (batch_size, seq_len))
+        if self.attn_bias is not None:
+            scores = scores + self.attn_bias
+        return scores
 
-            # compute context vector
-            cv = F.reshape(F.batch_matmul(F.swapaxes(self.enc_states, 2, 1), alphas),
-                                         shape=(batch_size, n_units))
+    def compute_context_vector(self, batches=True):
+        h = self[self.lstm_dec[-1]].h
+        # attention weights for the hidden states of each word in the input list
+        alphas = F.softmax(self.attention_scores(h))
+        if batches:
+            # (batch, units, seq) x (batch, seq) -> (batch, units)
+            cv = F.reshape(F.batch_matmul(self.attn_values, alphas), h.shape)
         else:
             # without batches
-            alphas = F.softmax(F.matmul(self[self.lstm_dec[-1]].h, self.enc_states, transb=True))
-            # compute context vector
-            if self.attn == SOFT_ATTN:
-                cv = F.batch_matmul(self.enc_states, F.transpose(alphas))
-                cv = F.transpose(F.sum(cv, axis=0))
-            else:
-                print("nothing to see here ...")
+            cv = F.matmul(alphas, self.attn_values)
 
         return cv, alphas
 
@@ -273,26 +493,29 @@ class EncoderDecoder(Chain):
         # convert list of tokens into chainer variable list
         var_dec = (Variable(xp.asarray(decoder_word_list, dtype=np.int32).reshape((-1,1)),
                             volatile=not train))
-        # Initialise first decoded word to GOID
-        pred_word = Variable(xp.asarray([GO_ID], dtype=np.int32), volatile=not train)
+        sample = train and self.sampling_ratio > 0
+        pred_word = None
 
         # compute loss
         self.loss = 0
-        # decode tokens
-        for next_word_var in var_dec[1:]:
-            self.decode(pred_word, train=train)
+        # decode tokens, feeding the gold previous token
+        for i in range(1, len(var_dec)):
+            word = var_dec[i-1]
+            if pred_word is not None and np.random.rand() < self.sampling_ratio:
+                word = Variable(xp.asarray([pred_word], dtype=np.int32), volatile=not train)
+            self.decode(word, train=train)
             if self.attn:
                 cv, _ = self.compute_context_vector(batches=False)
                 cv_hdec = F.concat((cv, self[self.lstm_dec[-1]].h), axis=1)
                 ht = F.tanh(self.context(cv_hdec))
-                predicted_out = self.out(ht)
+                predicted_out = self.project_out(ht)
             else:
-                predicted_out = self.out(self[self.lstm_dec[-1]].h)
+                predicted_out = self.project_out(self[self.lstm_dec[-1]].h)
+            if sample:
+                # argmax of the logits, no softmax needed
+                pred_word = int(predicted_out.data.argmax())
             # compute loss
-            prob = F.softmax(predicted_out)
-            pred_word = F.argmax(prob)
-            pred_word = Variable(xp.asarray([pred_word.data], dtype=np.int32), volatile=not train)
-            self.loss += F.softmax_cross_entropy(predicted_out, next_word_var)
+            self.loss += F.softmax_cross_entropy(predicted_out, var_dec[i])
         report({"loss":self.loss},self)
 
         return self.loss
@@ -300,9 +523,17 @@ class EncoderDecoder(Chain):
     #--------------------------------------------------------------------
     # For SGD - Batch size = 1
     #--------------------------------------------------------------------
-    def decoder_predict(self, start_word, max_predict_len=20):
+    def decoder_predict(self, start_word, max_predict_len=20, shortlist=None, record_attn=False):
+        '''
+        shortlist:   optional array of candidate target ids, see nmt_shortlist
+        record_attn: if True, also return the (predicted, source) attention
+                     weights, otherwise None
+        '''
         xp = cuda.cupy if self.gpuid >= 0 else np
-        alpha_arr = xp.empty((0,self.enc_states.shape[0]), dtype=xp.float32)
+        out_rows = self.shortlist_out(shortlist) if shortlist is not None else None
+        alpha_arr = None
+        if record_attn and self.attn:
+            alpha_arr = xp.empty((max_predict_len, self.enc_states.shape[0]), dtype=xp.float32)
 
         # return list of predicted words
         predicted_sent = []
@@ -319,13 +550,13 @@ class EncoderDecoder(Chain):
                 cv, alpha_list = self.compute_context_vector(batches=False)
                 # concatenate hidden state
                 cv_hdec = F.concat((cv, self[self.lstm_dec[-1]].h), axis=1)
-                # add alphas row
-                alpha_arr = xp.vstack((alpha_arr, alpha_list.data))
+                if alpha_arr is not None:
+                    alpha_arr[pred_count] = alpha_list.data[0]
 
                 ht = F.tanh(self.context(cv_hdec))
-                prob = F.softmax(self.out(ht))
+                prob = F.softmax(self.project_out(ht, out_rows))
             else:
-                prob = F.softmax(self.out(self[self.lstm_dec[-1]].h))
+                prob = F.softmax(self.project_out(self[self.lstm_dec[-1]].h, out_rows))
 
             if self.gpuid >= 0:
                 prob = cuda.to_cpu(prob.data)[0].astype(np.float64)
@@ -334,15 +565,20 @@ class EncoderDecoder(Chain):
             #prob /= np.sum(prob)
             #pred_word = np.random.choice(range(len(prob)), p=prob)
             pred_word = np.argmax(prob)
+            if shortlist is not None:
+                pred_word = int(shortlist[pred_word])
             predicted_sent.append(pred_word)
             prev_word = Variable(xp.asarray([pred_word], dtype=np.int32), volatile=True)
             pred_count += 1
+        if alpha_arr is not None:
+            alpha_arr = alpha_arr[:pred_count]
         return predicted_sent, alpha_arr
 
     #--------------------------------------------------------------------
     # For SGD - Batch size = 1
     #--------------------------------------------------------------------
-    def encode_decode_predict(self, in_word_list, max_predict_len=20):
+    def encode_decode_predict(self, in_word_list, max_predict_len=20, shortlist=None,
+                              record_attn=False):
         xp = cuda.cupy if self.gpuid >= 0 else np
         self.reset_state()
         # encode list of words/tokens
@@ -352,13 +588,74 @@ class EncoderDecoder(Chain):
         # initialize decoder LSTM to final encoder state
         self.set_decoder_state()
         # decode starting with GO_ID
-        predicted_sent, alpha_arr = self.decoder_predict(GO_ID, max_predict_len)
+        predicted_sent, alpha_arr = self.decoder_predict(GO_ID, max_predict_len, shortlist,
+                                                         record_attn)
         return predicted_sent, alpha_arr
 
 
     #--------------------------------------------------------------------
     # For batch size > 1
     #--------------------------------------------------------------------
+    def predict_src_lim(self, in_word_lists):
+        # padded source length of a batch in encode_decode_predict_batch
+        src_lim = max(1, max(len(src) for src in in_word_lists))
+        if self.convolutional:
+            # round up to whole segments like batch_pad_lims in training, so
+            # that the pooling segments line up the same way
+            src_lim = -(-src_lim // self.segment_size) * self.segment_size
+        return src_lim
+
+    def encode_decode_predict_batch(self, in_word_lists, max_predict_len=20, shortlist=None,
+                                    src_lim=None):
+        '''
+        Greedy decoding of a batch of sentences, best with sentences of
+        similar length (see nmt_infer). Sources are padded at the start, as
+        in training, to src_lim (default predict_src_lim). Rows that
+        predicted EOS_ID are dropped from the batch, so later steps only
+        decode the unfinished sentences. Returns one list of predicted ids
+        per sentence, ending with EOS_ID unless max_predict_len was reached.
+        '''
+        xp = cuda.cupy if self.gpuid >= 0 else np
+        self.reset_state()
+        if src_lim is None:
+            src_lim = self.predict_src_lim(in_word_lists)
+        fwd_encoder_batch = xp.vstack([self.pad_list(src, src_lim) for src in in_word_lists])
+        rev_encoder_batch = xp.vstack([self.pad_list(src[::-1], src_lim) for src in in_word_lists])
+        self.encode_batch(fwd_encoder_batch, rev_encoder_batch, train=False)
+        self.set_decoder_state()
+
+        batch_size = len(in_word_lists)
+        predicted_sents = [[] for _ in range(batch_size)]
+        # sentence of each row still being decoded
+        active = np.arange(batch_size)
+        prev_word = Variable(xp.full((batch_size,), GO_ID, dtype=xp.int32), volatile=True)
+        out_rows = self.shortlist_out(shortlist) if shortlist is not None else None
+
+        for pred_count in range(max_predict_len):
+            self.decode(prev_word, train=False)
+            if self.attn:
+                cv, _ = self.compute_context_vector()
+                cv_hdec = F.concat((cv, self[self.lstm_dec[-1]].h), axis=1)
+                predicted_out = self.project_out(F.tanh(self.context(cv_hdec)), out_rows)
+            else:
+                predicted_out = self.project_out(self[self.lstm_dec[-1]].h, out_rows)
+
+            pred_words = cuda.to_cpu(xp.argmax(predicted_out.data, axis=1))
+            if shortlist is not None:
+                pred_words = np.asarray(shortlist)[pred_words]
+            for row, word in zip(active, pred_words):
+                predicted_sents[row].append(int(word))
+            finished = (pred_words == EOS_ID) | (pred_words == PAD_ID)
+            if finished.all():
+                break
+            if finished.any():
+                keep = np.flatnonzero(~finished)
+                self.select_rows(xp.asarray(keep))
+                active, pred_words = active[keep], pred_words[keep]
+            prev_word = Variable(xp.asarray(pred_words, dtype=xp.int32), volatile=True)
+
+        return predicted_sents
+
     def pad_list(self, data, lim, at_start=True):
         xp = cuda.cupy if self.gpuid >= 0 else np
         if at_start:
@@ -377,8 +674,6 @@ class EncoderDecoder(Chain):
 
         var_rev_en = (Variable(rev_encoder_batch.T, volatile=(not train)))
 
-        first_entry = True
-
         seq_len, batch_size = var_en.shape
 
 
@@ -393,60 +688,74 @@ class EncoderDecoder(Chain):
         else:
             seq_len, batch_size = var_en.shape
 
-        if self.attn:
-
-            if self.convolutional:
-                self.mask = xp.asarray(fwd_encoder_batch, dtype=bool)
-                new_mask = []
-                for i in range(len(self.mask)):
-                    new_i = []
-                    lenphr = len(self.mask[i])
-                    for j in range(-(-lenphr // segment_size)):
-                        k = min((lenphr - 1), (segment_size * (j+1)))
-
-
-                        if any(self.mask[i][j:k]):
-                            new_i.append(True)
-                        else:
-                            new_i.append(False)
-                    new_mask.append(new_i)
+        # for all sequences in the batch, feed the characters one by one
+        if self.recompute_chunk > 0 and train:
+            fwd_hs, rev_hs = self.encode_steps_chunked(var_en, var_rev_en, seq_len,
+                                                       batch_size, train)
+        else:
+            fwd_hs, rev_hs = self.encode_steps([var_en[i] for i in range(seq_len)],
+                                               [var_rev_en[i] for i in range(seq_len)], train)
 
-                self.mask = self.xp.expand_dims(new_mask, -1)
+        # the reverse LSTM states are aligned with the forward ones
+        self.forward_states = F.concat([F.reshape(h, shape=(batch_size, 1, self.n_units))
+                                        for h in fwd_hs], axis=1)
+        self.backward_states = F.concat([F.reshape(h, shape=(batch_size, 1, self.n_units))
+                                         for h in reversed(rev_hs)], axis=1)
 
-            else:
-                self.mask = self.xp.expand_dims(fwd_encoder_batch != 0, -1)
-            self.minf = Variable(self.xp.full((batch_size, seq_len, 1), -1000.,
-                                 dtype=self.xp.float32), volatile=not train)
-
-        # for all sequences in the batch, feed the characters one by one
-        for i in range(seq_len):
-            # encode tokens
-            w = var_en[i]
-            rev_w = var_rev_en[i]
+        self.enc_states = F.concat((self.forward_states, self.backward_states), axis=2)
 
+        if self.attn:
+            mask = fwd_encoder_batch != PAD_ID
+            if self.convolutional:
+                # a segment is padding if all of its tokens are
+                src_len = mask.shape[1]
+                num_seg = -(-src_len // self.segment_size)
+                mask = xp.pad(mask, ((0, 0), (0, num_seg * self.segment_size - src_len)),
+                              "constant")
+                mask = mask.reshape((len(mask), num_seg, self.segment_size)).any(axis=2)
+            self.precompute_attention(mask, train=train)
+
+    def encode_steps(self, words, rev_words, train):
+        # feed one step of each direction at a time, return the top hidden states
+        fwd_hs, rev_hs = [], []
+        for w, rev_w in zip(words, rev_words):
             self.encode(w, self.lstm_enc, train)
             self.encode(rev_w, self.lstm_rev_enc, train)
-
-            if first_entry == False:
-
-                self.forward_states = F.concat((self.forward_states,
-                                                F.reshape(self[self.lstm_enc[-1]].h,
-                                                shape=(batch_size, 1, self.n_units))), axis=1)
-
-                self.backward_states = F.concat((F.reshape(self[self.lstm_rev_enc[-1]].h,
-                                                shape=(batch_size, 1, self.n_units)),
-                                                self.backward_states), axis=1)
+            fwd_hs.append(self[self.lstm_enc[-1]].h)
+            rev_hs.append(self[self.lstm_rev_enc[-1]].h)
+        return fwd_hs, rev_hs
+
+    def encode_steps_chunked(self, var_en, var_rev_en, seq_len, batch_size, train):
+        enc_layers = self.lstm_enc + self.lstm_rev_enc
+        n_states = 2 * len(enc_layers)
+        self.init_lstm_states(enc_layers, batch_size)
+        fwd_hs, rev_hs = [], []
+        for start in range(0, seq_len, self.recompute_chunk):
+            end = min(start + self.recompute_chunk, seq_len)
+            n_steps = end - start
+            # convolutional inputs need gradients, so they go through forget;
+            # word ids are read from the closure
+            if self.convolutional:
+                inputs = ([var_en[i] for i in range(start, end)] +
+                          [var_rev_en[i] for i in range(start, end)])
             else:
-                self.forward_states = F.reshape(self[self.lstm_enc[-1]].h,
-                                                shape=(batch_size, 1, self.n_units))
+                inputs = []
 
-                self.backward_states = F.reshape(self[self.lstm_rev_enc[-1]].h,
-                                                shape=(batch_size, 1, self.n_units))
+            def run_chunk(*args, start=start, end=end):
+                self.set_lstm_states(enc_layers, args[:n_states])
+                if self.convolutional:
+                    words, rev_words = args[n_states:n_states+n_steps], args[n_states+n_steps:]
+                else:
+                    words = [var_en[i] for i in range(start, end)]
+                    rev_words = [var_rev_en[i] for i in range(start, end)]
+                chunk_fwd, chunk_rev = self.encode_steps(words, rev_words, train)
+                return tuple(self.lstm_states(enc_layers)) + tuple(chunk_fwd) + tuple(chunk_rev)
 
-
-                first_entry = False
-
-        self.enc_states = F.concat((self.forward_states, self.backward_states), axis=2)
+            outs = self.recompute(run_chunk, *(self.lstm_states(enc_layers) + inputs))
+            self.set_lstm_states(enc_layers, outs[:n_states])
+            fwd_hs += outs[n_states:n_states+n_steps]
+            rev_hs += outs[n_states+n_steps:]
+        return fwd_hs, rev_hs
 
 
     #--------------------------------------------------------------------
@@ -457,33 +766,84 @@ class EncoderDecoder(Chain):
         # convert list of tokens into chainer variable list
         var_dec = (Variable(decoder_batch.T, volatile=(not train)))
 
-        # Initialise first decoded word to GOID
-        pred_word = var_dec[0]
+        seq_len, batch_size = var_dec.shape
+        # scheduled sampling: the rows that are fed their own prediction at
+        # each step, drawn up front so that recomputed chunks see the same
+        sample = None
+        if train and self.sampling_ratio > 0:
+            sample = xp.random.rand(seq_len, batch_size) < self.sampling_ratio
 
-        loss = 0
+        if self.recompute_chunk > 0 and train:
+            return self.decode_steps_chunked(var_dec, seq_len, train, sample)
 
-        seq_len, batch_size = var_dec.shape
         # for all sequences in the batch, feed the characters one by one
-        for i in range(1, seq_len):
+        pred_word, loss = self.decode_steps(None, var_dec, 1, seq_len, train, sample)
+
+        return loss
+
+    def decode_steps(self, pred_word, var_dec, start, end, train, sample=None):
+        '''
+        Decode timesteps start..end-1 with teacher forcing: step i is fed the
+        gold token var_dec[i-1], or where sample[i] is set, the prediction of
+        the previous step. Returns the last prediction (None without
+        sample) and the loss.
+        '''
+        xp = cuda.cupy if self.gpuid >= 0 else np
+        loss = 0
+        for i in range(start, end):
+            word = var_dec[i-1]
+            if pred_word is not None:
+                word = Variable(xp.where(sample[i], pred_word, word.data).astype(xp.int32),
+                                volatile=not train)
             # encode tokens
-            self.decode(pred_word, train)
+            self.decode(word, train)
 
             if self.attn:
                 cv, _ = self.compute_context_vector()
                 cv_hdec = F.concat((cv, self[self.lstm_dec[-1]].h), axis=1)
                 ht = F.tanh(self.context(cv_hdec))
-                predicted_out = self.out(ht)
+                predicted_out = self.project_out(ht)
             else:
-                predicted_out = self.out(self[self.lstm_dec[-1]].h)
+                predicted_out = self.project_out(self[self.lstm_dec[-1]].h)
 
-            prob = F.softmax(predicted_out)
-            pred_word = F.expand_dims(F.argmax(prob, axis=1), -1)
+            if sample is not None:
+                # argmax of the logits, no softmax needed
+                pred_word = predicted_out.data.argmax(axis=1)
 
             w = var_dec[i]
             loss_arr = F.softmax_cross_entropy(predicted_out, w,
                                                class_weight=self.mask_pad_id)
             loss += loss_arr
 
+        return pred_word, loss
+
+    def decode_steps_chunked(self, var_dec, seq_len, train, sample=None):
+        n_states = 2 * len(self.lstm_dec)
+        attn_inputs = self.attention_inputs() if self.attn else (self.enc_states,)
+        # the prediction fed back by scheduled sampling does not need
+        # gradients, so it is carried from one chunk to the next outside of
+        # forget
+        carry = {"pred_word": None}
+        loss = 0
+        for start in range(1, seq_len, self.recompute_chunk):
+            end = min(start + self.recompute_chunk, seq_len)
+
+            def run_chunk(*args, start=start, end=end, pred_word=carry["pred_word"]):
+                if self.attn:
+                    self.set_attention_inputs(args[:len(attn_inputs)])
+                states = args[len(attn_inputs):]
+                self.set_lstm_states(self.lstm_dec, states)
+                pred_word, chunk_loss = self.decode_steps(pred_word, var_dec, start, end,
+                                                          train, sample)
+                carry["pred_word"] = pred_word
+                return (chunk_loss,) + tuple(self.lstm_states(self.lstm_dec))
+
+            outs = self.recompute(run_chunk, *(attn_inputs + tuple(self.lstm_states(self.lstm_dec))))
+            self.set_lstm_states(self.lstm_dec, outs[1:1+n_states])
+            loss += outs[0]
+
+        if self.attn:
+            self.set_attention_inputs(attn_inputs)
         return loss
 
     #--------------------------------------------------------------------
@@ -493,26 +853,29 @@ class EncoderDecoder(Chain):
         xp = cuda.cupy if self.gpuid >= 0 else np
         self.reset_state()
 
-        fwd_encoder_batch = xp.empty((0, src_lim), dtype=xp.int32)
-        rev_encoder_batch = xp.empty((0, src_lim), dtype=xp.int32)
-        decoder_batch = xp.empty((0, tar_lim+2), dtype=xp.int32)
+        with self.phase("batch"):
+            fwd_encoder_batch = xp.empty((0, src_lim), dtype=xp.int32)
+            rev_encoder_batch = xp.empty((0, src_lim), dtype=xp.int32)
+            decoder_batch = xp.empty((0, tar_lim+2), dtype=xp.int32)
 
-        for src, tar in batch_data:
-            fwd_encoder_batch = xp.vstack((fwd_encoder_batch, self.pad_list(src, src_lim)))
-            rev_encoder_batch = xp.vstack((rev_encoder_batch, self.pad_list(src[::-1], src_lim)))
+            for src, tar in batch_data:
+                fwd_encoder_batch = xp.vstack((fwd_encoder_batch, self.pad_list(src, src_lim)))
+                rev_encoder_batch = xp.vstack((rev_encoder_batch, self.pad_list(src[::-1], src_lim)))
 
-            tar_data = [GO_ID] + tar + [EOS_ID]
-            decoder_batch = xp.vstack((decoder_batch, self.pad_list(tar_data,
-                                                                    tar_lim+2, at_start=False)))
+                tar_data = [GO_ID] + tar + [EOS_ID]
+                decoder_batch = xp.vstack((decoder_batch, self.pad_list(tar_data,
+                                                                        tar_lim+2, at_start=False)))
 
         # encode list of words/tokens
-        self.encode_batch(fwd_encoder_batch, rev_encoder_batch, train=train)
+        with self.phase("encode"):
+            self.encode_batch(fwd_encoder_batch, rev_encoder_batch, train=train)
 
 
-        # initialize decoder LSTM to final encoder state
-        self.set_decoder_state()
-        # decode and compute loss
-        self.loss = self.decode_batch(decoder_batch, train=train)
+        with self.phase("decode"):
+            # initialize decoder LSTM to final encoder state
+            self.set_decoder_state()
+            # decode and compute loss
+            self.loss = self.decode_batch(decoder_batch, train=train)
 
         return self.loss
 
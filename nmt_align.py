@@ -0,0 +1,113 @@
+# coding: utf-8
+
+# ## Sparse attention alignments
+#
+# For bulk analysis the attention of every predicted word is reduced to its
+# top_k source positions and weights. All sentences are stored column-wise
+# in one compressed .npz:
+#
+#     sent_ptr  (num_sents+1,)      predicted words of sentence s are rows
+#                                   sent_ptr[s]:sent_ptr[s+1]
+#     src_len   (num_sents,)        attention positions: source tokens, or
+#                                   source segments in convolutional mode
+#     src_ids   / pred_ids          flattened ids, with src_ptr / sent_ptr
+#     index     (num_words, top_k)  source positions, -1 if src_len < top_k
+#     weight    (num_words, top_k)  attention weights, float16
+
+# In[ ]:
+
+import numpy as np
+
+
+# In[ ]:
+
+def top_k_alignment(alpha_arr, top_k):
+    '''
+    alpha_arr: (predicted, source) attention weights. Returns the top_k
+    source positions per row, highest weight first, and their weights.
+    '''
+    num_rows, src_len = alpha_arr.shape
+    k = min(top_k, src_len)
+    index = np.full((num_rows, top_k), -1, dtype=np.int32)
+    weight = np.zeros((num_rows, top_k), dtype=np.float16)
+    if num_rows == 0 or k == 0:
+        return index, weight
+    part = np.argpartition(-alpha_arr, k - 1, axis=1)[:, :k]
+    part_w = np.take_along_axis(alpha_arr, part, axis=1)
+    order = np.argsort(-part_w, axis=1, kind="stable")
+    index[:, :k] = np.take_along_axis(part, order, axis=1)
+    weight[:, :k] = np.take_along_axis(part_w, order, axis=1)
+    return index, weight
+
+
+class AlignmentWriter(object):
+    '''
+    Collects sparse alignments sentence by sentence, e.g.:
+        writer = AlignmentWriter(top_k=5)
+        writer.add(src_ids, pred_ids, alpha_arr)
+        writer.save(fname)
+    '''
+    def __init__(self, top_k=5):
+        self.top_k = top_k
+        self.src_ids, self.pred_ids = [], []
+        self.index, self.weight = [], []
+        self.src_len = []
+
+    def __len__(self):
+        return len(self.src_ids)
+
+    def add(self, src_ids, pred_ids, alpha_arr):
+        alpha_arr = np.asarray(alpha_arr, dtype=np.float32)
+        index, weight = top_k_alignment(alpha_arr, self.top_k)
+        self.src_ids.append(np.asarray(src_ids, dtype=np.int32))
+        self.pred_ids.append(np.asarray(pred_ids, dtype=np.int32))
+        self.index.append(index)
+        self.weight.append(weight)
+        # not len(src_ids): convolutional models attend over segments
+        self.src_len.append(alpha_arr.shape[1])
+
+    def arrays(self):
+        def ptr(lists):
+            return np.concatenate(([0], np.cumsum([len(a) for a in lists]))).astype(np.int64)
+
+        def cat(lists, dtype, shape=(0,)):
+            return np.concatenate(lists) if lists else np.zeros(shape, dtype=dtype)
+
+        return {"top_k": np.asarray(self.top_k),
+                "sent_ptr": ptr(self.pred_ids),
+                "src_ptr": ptr(self.src_ids),
+                "src_len": np.asarray(self.src_len, dtype=np.int32),
+                "src_ids": cat(self.src_ids, np.int32),
+                "pred_ids": cat(self.pred_ids, np.int32),
+                "index": cat(self.index, np.int32, (0, self.top_k)),
+                "weight": cat(self.weight, np.float16, (0, self.top_k))}
+
+    def save(self, fname):
+        with open(fname, "wb") as out_f:
+            np.savez_compressed(out_f, **self.arrays())
+        print("finished writing {0:d} alignments: {1:s}".format(len(self), fname))
+
+
+# In[ ]:
+
+def load_alignments(fname):
+    with np.load(fname) as npz:
+        return {k: npz[k] for k in npz.files}
+
+
+def sentence_alignment(data, s, dense=False):
+    '''
+    Alignment of sentence s from load_alignments: (src_ids, pred_ids, index,
+    weight), or with dense=True a (predicted, source) weight matrix in place
+    of index and weight.
+    '''
+    start, end = data["sent_ptr"][s], data["sent_ptr"][s+1]
+    src_ids = data["src_ids"][data["src_ptr"][s]:data["src_ptr"][s+1]]
+    pred_ids = data["pred_ids"][start:end]
+    index, weight = data["index"][start:end], data["weight"][start:end]
+    if not dense:
+        return src_ids, pred_ids, index, weight
+    alpha_arr = np.zeros((end - start, data["src_len"][s]), dtype=np.float32)
+    rows, cols = np.nonzero(index >= 0)
+    alpha_arr[rows, index[rows, cols]] = weight[rows, cols]
+    return src_ids, pred_ids, alpha_arr
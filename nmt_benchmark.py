@@ -0,0 +1,289 @@
+# coding: utf-8
+
+# ## Micro-benchmarks
+#
+# Times the encoder-decoder hot paths on synthetic data, on the CPU, and
+# writes the results as JSON so that runs can be compared:
+#
+#     python nmt_benchmark.py [bench.json]
+#
+# Everything runs inside a temporary directory holding a synthetic corpus and
+# vocabulary, so no data or model files are needed.
+
+# In[ ]:
+
+import os
+import re
+import sys
+import json
+import time
+import pickle
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+BATCH_SIZES = [1, 16, 64]
+SEQ_LENS = [10, 30, 60, 100]
+REPEATS = 3
+NUM_CORPUS_LINES = 2000
+SEED = 1234
+
+
+# In[ ]:
+
+def synthetic_vocab(char, size):
+    # ids follow START_VOCAB, like prepare_seq2seq.create_vocab
+    from nmt_config import START_VOCAB
+    if char:
+        symbols = list(range(ord("a"), ord("z")+1)) + [ord(" ")]
+    else:
+        symbols = [("w{0:d}".format(k)).encode() for k in range(size - len(START_VOCAB))]
+    vocab_list = START_VOCAB + symbols
+    w2i = {w: i for i, w in enumerate(vocab_list)}
+    i2w = {i: w for i, w in enumerate(vocab_list)}
+    return w2i, i2w
+
+
+def synthetic_line(rng, char, max_len):
+    if char:
+        length = rng.randint(1, max_len)
+        return bytes(rng.choice(list(b"abcdefghijklmnopqrstuvwxyz "), length).tolist())
+    length = rng.randint(1, max(2, max_len // 5))
+    return b" ".join(("w{0:d}".format(k)).encode() for k in rng.randint(0, 500, length))
+
+
+def write_synthetic_inputs(rng):
+    from nmt_config import (input_dir, text_fname, w2i_path, i2w_path, vocab_path,
+                            CONVOLUTIONAL, BUCKET_WIDTH, NUM_BUCKETS)
+    if not os.path.exists(input_dir):
+        os.makedirs(input_dir)
+    w2i, i2w, vocab = {}, {}, {}
+    for lang in ("fr", "en"):
+        w2i[lang], i2w[lang] = synthetic_vocab(CONVOLUTIONAL, 1000)
+        vocab[lang] = {w: 1 for w in w2i[lang]}
+        with open(text_fname[lang], "wb") as out_f:
+            for _ in range(NUM_CORPUS_LINES):
+                out_f.write(synthetic_line(rng, CONVOLUTIONAL, BUCKET_WIDTH * NUM_BUCKETS) + b"\n")
+    pickle.dump(vocab, open(vocab_path, "wb"))
+    pickle.dump(w2i, open(w2i_path, "wb"))
+    pickle.dump(i2w, open(i2w_path, "wb"))
+
+
+def synthetic_sentence(rng, max_len):
+    # raw subtitle-like text: mixed case and punctuation
+    words = []
+    for k in rng.randint(0, 500, rng.randint(1, max_len)):
+        word = ("w{0:d}".format(k)).encode()
+        if rng.rand() < 0.2:
+            word = word.upper()
+        if rng.rand() < 0.2:
+            word += bytes([rng.choice(list(b".,!?\"':~;)("))])
+        words.append(word)
+    return b" ".join(words) + b"\n"
+
+
+_WORD_SPLIT = re.compile(b"([.,!?\"':~;)(])")
+
+
+def split_tokenizer(sentence):
+    # the per-fragment regex tokenizer that basic_tokenizer replaced
+    words = []
+    for space_separated_fragment in sentence.strip().split():
+        words.extend(_WORD_SPLIT.sub(b"", w) for w in _WORD_SPLIT.split(space_separated_fragment))
+    return [w.lower() for w in words if w]
+
+
+# In[ ]:
+
+def measure(fn, repeats=REPEATS):
+    '''
+    Run fn once to warm up, then time `repeats` runs and measure the peak
+    traced allocation of one extra run.
+    '''
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds_min": min(times), "seconds_mean": sum(times) / len(times),
+            "peak_mem_bytes": peak}
+
+
+def record(results, name, batch_size, seq_len, tokens, stats):
+    stats = dict(stats)
+    stats.update({"name": name, "batch_size": batch_size, "seq_len": seq_len,
+                  "tokens": tokens,
+                  "tokens_per_sec": tokens / stats["seconds_min"] if stats["seconds_min"] else 0.})
+    results.append(stats)
+    print("{0:28s} | batch={1:3d} | len={2:3d} | {3:9.4f}s | {4:10.1f} tok/s | {5:8.1f} KiB".format(
+          name, batch_size, seq_len, stats["seconds_min"], stats["tokens_per_sec"],
+          stats["peak_mem_bytes"] / 1024.))
+
+
+# In[ ]:
+
+def run_benchmarks():
+    rng = np.random.RandomState(SEED)
+    np.random.seed(SEED)
+    write_synthetic_inputs(rng)
+
+    import chainer
+    from chainer import Variable
+    import nmt_translate as nmt
+
+    vsize_fr, vsize_en = nmt.vocab_size_fr, nmt.vocab_size_en
+    results = []
+
+    def new_model(convolutional):
+        return nmt.EncoderDecoder(vsize_fr, vsize_en,
+                                  nmt.num_layers_enc, nmt.num_layers_dec, nmt.num_layers_highway,
+                                  nmt.hidden_units, -1, nmt.segment_size, nmt.num_filters_conv,
+                                  attn=nmt.use_attn, convolutional=convolutional,
+                                  attn_score=nmt.attn_score, sampling_ratio=nmt.sampling_ratio)
+
+    model = new_model(nmt.CONVOLUTIONAL)
+    conv_model = model if nmt.CONVOLUTIONAL else new_model(True)
+
+    def random_ids(vsize, n):
+        return rng.randint(4, vsize, n).tolist()
+
+    for seq_len in SEQ_LENS:
+        for batch_size in BATCH_SIZES:
+            batch = [(random_ids(vsize_fr, seq_len), random_ids(vsize_en, seq_len))
+                     for _ in range(batch_size)]
+            tokens = 2 * seq_len * batch_size
+
+            def train_forward():
+                model.encode_decode_train_batch(batch, seq_len, seq_len)
+            record(results, "encode_decode_train_batch", batch_size, seq_len, tokens,
+                   measure(train_forward))
+
+            def train_step():
+                loss = model.encode_decode_train_batch(batch, seq_len, seq_len)
+                model.cleargrads()
+                loss.backward()
+            record(results, "train_batch+backward", batch_size, seq_len, tokens,
+                   measure(train_step))
+
+            src_ids = Variable(np.asarray([src for src, _ in batch], dtype=np.int32))
+
+            def conv_embed():
+                conv_model.convolution_embed(src_ids)
+            record(results, "convolution_embed", batch_size, seq_len, seq_len * batch_size,
+                   measure(conv_embed))
+
+            # encoder states and decoder state for the attention step
+            model.encode_decode_train_batch(batch, seq_len, seq_len, train=False)
+            if model.attn:
+                def context_vector():
+                    model.compute_context_vector()
+                record(results, "compute_context_vector", batch_size, seq_len,
+                       seq_len * batch_size, measure(context_vector))
+
+            def predict():
+                for src, _ in batch:
+                    model.encode_decode_predict(src, max_predict_len=seq_len)
+            record(results, "encode_decode_predict", batch_size, seq_len,
+                   2 * seq_len * batch_size, measure(predict, repeats=1))
+
+            def predict_batch():
+                model.encode_decode_predict_batch([src for src, _ in batch], seq_len)
+            record(results, "encode_decode_predict_batch", batch_size, seq_len,
+                   2 * seq_len * batch_size, measure(predict_batch, repeats=1))
+
+            pairs = [(random_ids(vsize_en, seq_len), random_ids(vsize_en, seq_len))
+                     for _ in range(batch_size)]
+
+            def bleu_stats():
+                stats = [0 for i in range(10)]
+                for (r, h) in pairs:
+                    stats = [sum(scores) for scores in zip(stats, nmt.bleu_stats(h, r))]
+            record(results, "bleu_stats", batch_size, seq_len, tokens, measure(bleu_stats))
+
+    from nmt_quantize import QuantizedDecoder, float_arrays, quantized_arrays, quantized_predict
+    seq_len, batch_size = SEQ_LENS[1], BATCH_SIZES[1]
+    src_lists = [random_ids(vsize_fr, seq_len) for _ in range(batch_size)]
+    decoders = [("decoder_float32", QuantizedDecoder(float_arrays(model))),
+                ("decoder_int8", QuantizedDecoder(quantized_arrays(model, src_lists, seq_len)))]
+    for name, dec in decoders:
+        def numpy_decode():
+            for src in src_lists:
+                quantized_predict(model, dec, src, seq_len)
+        record(results, name, batch_size, seq_len, 2 * seq_len * batch_size,
+               measure(numpy_decode, repeats=1))
+
+    corpus_tokens = sum(os.path.getsize(nmt.text_fname[lang]) for lang in ("fr", "en"))
+
+    def rebuild_buckets():
+        # create_buckets skips the work when the manifest is up to date
+        if os.path.exists(nmt.bucket_manifest_fname):
+            os.remove(nmt.bucket_manifest_fname)
+        nmt.create_buckets()
+    record(results, "create_buckets", NUM_CORPUS_LINES, nmt.BUCKET_WIDTH * nmt.NUM_BUCKETS,
+           corpus_tokens, measure(rebuild_buckets, repeats=1))
+
+    from prepare_seq2seq import basic_tokenizer, count_tokens
+    sentences = [synthetic_sentence(rng, 30) for _ in range(10 * NUM_CORPUS_LINES)]
+    corpus_tokens = sum(len(split_tokenizer(line)) for line in sentences)
+    assert all(basic_tokenizer(line) == split_tokenizer(line) for line in sentences)
+
+    def tokenize():
+        for line in sentences:
+            basic_tokenizer(line)
+    record(results, "basic_tokenizer", len(sentences), 30, corpus_tokens, measure(tokenize))
+
+    def tokenize_split():
+        for line in sentences:
+            split_tokenizer(line)
+    record(results, "split_tokenizer", len(sentences), 30, corpus_tokens, measure(tokenize_split))
+
+    def vocab_counts():
+        count_tokens(sentences)
+    record(results, "count_tokens", len(sentences), 30, corpus_tokens, measure(vocab_counts))
+
+    return results
+
+
+def main(out_fname="bench.json"):
+    out_fname = os.path.abspath(out_fname)
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # nmt_config resolves data/model folders relative to the working dir
+        os.chdir(tmp_dir)
+        try:
+            results = run_benchmarks()
+        finally:
+            os.chdir(cwd)
+
+    import chainer
+    import nmt_config
+    report = {"platform": platform.platform(),
+              "python": platform.python_version(),
+              "numpy": np.__version__,
+              "chainer": chainer.__version__,
+              "config": {"convolutional": nmt_config.CONVOLUTIONAL,
+                         "hidden_units": nmt_config.hidden_units,
+                         "num_layers_enc": nmt_config.num_layers_enc,
+                         "num_layers_dec": nmt_config.num_layers_dec,
+                         "use_attn": nmt_config.use_attn,
+                         "attn_score": nmt_config.attn_score,
+                         "repeats": REPEATS, "seed": SEED},
+              "results": results}
+    with open(out_fname, "w") as out_f:
+        json.dump(report, out_f, indent=1)
+    print("results written to {0:s}".format(out_fname))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
@@ -0,0 +1,223 @@
+# coding: utf-8
+
+# ## Checkpointing
+#
+# Model (and optionally optimizer) state is copied into host memory on the
+# training thread and written to disk by a background thread, so training
+# does not stall on disk writes.
+
+# In[ ]:
+
+import os
+import re
+import time
+import threading
+import queue
+import numpy as np
+from chainer import cuda, serializers
+
+
+# In[ ]:
+
+def optimizer_fname(model_fname):
+    return model_fname.replace(".model", ".optimizer")
+
+
+def snapshot(obj, path=""):
+    # serialize into a dict of arrays and copy them, so that the parameters
+    # can keep changing while the copy is being written out
+    s = serializers.DictionarySerializer(path=path)
+    s.save(obj)
+    return {k: host_copy(v) for k, v in s.target.items()}
+
+
+def host_copy(v):
+    # numpy copy of a numpy or cupy array, or of a scalar
+    if isinstance(v, cuda.ndarray):
+        return cuda.to_cpu(v).copy()
+    return np.array(v, copy=True)
+
+
+def grow_arrays(arrays, obj, path=""):
+    '''
+    Arrays of obj that have more rows than the saved ones (embeddings, output
+    layer and their optimizer state after the vocabulary grew) get the saved
+    rows copied into their first rows, the remaining rows keep the values obj
+    has now. Returns the arrays to deserialize and the grown keys.
+    '''
+    arrays = dict(arrays)
+    grown = []
+    for key, value in snapshot(obj, path).items():
+        saved = arrays.get(key)
+        if (saved is not None and saved.ndim == value.ndim and saved.ndim > 0 and
+                saved.shape[1:] == value.shape[1:] and saved.shape[0] < value.shape[0]):
+            value[:saved.shape[0]] = saved
+            arrays[key] = value
+            grown.append(key)
+    return arrays, grown
+
+
+def load_npz_grow(fname, obj):
+    # serializers.load_npz, growing arrays as in grow_arrays
+    with np.load(fname) as npz:
+        arrays, grown = grow_arrays({k: npz[k] for k in npz.files}, obj)
+    serializers.NpzDeserializer(arrays).load(obj)
+    if grown:
+        print("grew {0:s}: {1:s}".format(fname, ", ".join(grown)))
+    return grown
+
+
+def write_npz(fname, arrays):
+    # write to a temp file and rename, so a crash never leaves a partial file
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, "wb") as out_f:
+        np.savez(out_f, **arrays)
+        out_f.flush()
+        os.fsync(out_f.fileno())
+    os.replace(tmp_fname, fname)
+
+
+def checkpoint_pair_matches(model_fname):
+    '''
+    True if the optimizer file next to model_fname was saved together with
+    it. Files without a checkpoint_id (older saves) are assumed to match.
+    '''
+    ids = []
+    for fname in (model_fname, optimizer_fname(model_fname)):
+        with np.load(fname) as npz:
+            ids.append(int(npz["checkpoint_id"]) if "checkpoint_id" in npz.files else None)
+    return ids[0] == ids[1]
+
+
+def prune_epoch_models(model_fname, keep):
+    '''
+    Delete all but the last `keep` per-epoch files "<model>_{epoch}.model",
+    along with their optimizer state. keep <= 0 keeps everything.
+    '''
+    if keep <= 0:
+        return
+    model_dir, base = os.path.split(model_fname)
+    pattern = re.compile(re.escape(base.replace(".model", "_")) + r"(\d+)\.model$")
+    epochs = sorted(int(m.group(1)) for m in map(pattern.match, os.listdir(model_dir or "."))
+                    if m)
+    for epoch_id in epochs[:-keep]:
+        fname = model_fname.replace(".model", "_{0:d}.model".format(epoch_id))
+        for old_fname in (fname, optimizer_fname(fname)):
+            if os.path.exists(old_fname):
+                os.remove(old_fname)
+
+
+class AsyncCheckpointer(object):
+    '''
+    Save model/optimizer snapshots from a background writer thread.
+        asynchronous: if False, write on the calling thread
+        max_pending:  number of snapshots allowed in memory before save blocks
+    '''
+    def __init__(self, asynchronous=True, max_pending=1):
+        self.asynchronous = asynchronous
+        self.error = None
+        if asynchronous:
+            self.jobs = queue.Queue(maxsize=max_pending)
+            self.writer = threading.Thread(target=self._run, daemon=True)
+            self.writer.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                job()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, job):
+        self._check_error()
+        if self.asynchronous:
+            self.jobs.put(job)
+        else:
+            job()
+
+    def save(self, model_fname, model, optimizer=None):
+        arrays = snapshot(model)
+        opt_arrays = snapshot(optimizer) if optimizer is not None else None
+        if opt_arrays is not None:
+            # both files carry the same id, so that a crash between the two
+            # renames is detected by checkpoint_pair_matches
+            arrays["checkpoint_id"] = opt_arrays["checkpoint_id"] = np.asarray(time.time_ns())
+
+        def job():
+            # optimizer first, the model file is replaced last
+            if opt_arrays is not None:
+                write_npz(optimizer_fname(model_fname), opt_arrays)
+            write_npz(model_fname, arrays)
+        self.submit(job)
+
+    def wait(self):
+        # block until all pending snapshots are on disk
+        if self.asynchronous:
+            self.jobs.join()
+        self._check_error()
+
+    def close(self):
+        if self.asynchronous and self.writer.is_alive():
+            self.jobs.put(None)
+            self.writer.join()
+        self._check_error()
+
+
+# In[ ]:
+
+# ### Resumable training state
+#
+# A resume checkpoint holds the model, the optimizer, the position in the
+# bucketed training data and the numpy RNG state (used by dropout), so that
+# an interrupted epoch continues from the last saved batch.
+
+def resume_fname(model_fname):
+    return model_fname.replace(".model", "_resume.model")
+
+
+def rng_snapshot():
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {"rng/keys": np.array(keys, copy=True),
+            "rng/pos": np.asarray(pos),
+            "rng/has_gauss": np.asarray(has_gauss),
+            "rng/cached_gaussian": np.asarray(cached_gaussian)}
+
+
+def save_resume(checkpointer, fname, model, optimizer, position):
+    '''
+    position: dict of scalars describing where training stopped
+    '''
+    arrays = snapshot(model, "model/")
+    arrays.update(snapshot(optimizer, "optimizer/"))
+    arrays.update({"position/" + k: np.asarray(v) for k, v in position.items()})
+    arrays.update(rng_snapshot())
+    checkpointer.submit(lambda: write_npz(fname, arrays))
+
+
+def load_resume(fname, model, optimizer):
+    with np.load(fname) as npz:
+        arrays = {k: npz[k] for k in npz.files}
+        arrays, _ = grow_arrays(arrays, model, "model/")
+        arrays, _ = grow_arrays(arrays, optimizer, "optimizer/")
+        serializers.NpzDeserializer(arrays, path="model/").load(model)
+        serializers.NpzDeserializer(arrays, path="optimizer/").load(optimizer)
+        position = {k[len("position/"):]: npz[k].item()
+                    for k in npz.files if k.startswith("position/")}
+        np.random.set_state(("MT19937", npz["rng/keys"], int(npz["rng/pos"]),
+                             int(npz["rng/has_gauss"]), float(npz["rng/cached_gaussian"])))
+    return position
+
+
+def remove_resume(fname):
+    if os.path.exists(fname):
+        os.remove(fname)
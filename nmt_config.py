@@ -119,6 +119,28 @@ elif DATASET == "INUKTITUT":
         # 100K
         EXP_NAME= EXP_NAME_PREFIX + "_ailliijuq"
 #-----------------------------------------------------------------
+# Training pairs are bucketed by (source length, target length): source
+# lengths in bins of BUCKET_WIDTH, target lengths in bins of
+# TGT_BUCKET_WIDTH. Each batch is padded to its own longest sentences.
+TGT_BUCKET_WIDTH = BUCKET_WIDTH
+NUM_TGT_BUCKETS = NUM_BUCKETS
+NUM_BUCKET_FILES = NUM_BUCKETS * NUM_TGT_BUCKETS
+# processes used by create_buckets, 0 uses all cpus
+bucket_workers = 0
+# continue training only on the data added with prepare_seq2seq's
+# append_input_config since the buckets were first created
+train_appended_only = False
+# Morfessor segmenter (MORFESSOR dataset). The corpus is streamed into a
+# word count list of at most morf_max_words distinct words (the rarest are
+# dropped when it grows past that), keeping a morf_subsample fraction of
+# the lines. morf_online trains with Morfessor's online algorithm instead
+# of batch training. morf_dampening: "none", "log" or "ones" count
+# dampening, as in the morfessor command line tool.
+morf_online = False
+morf_max_words = 2000000
+morf_subsample = 1.0
+morf_dampening = "none"
+morf_epoch_interval = 10000
 
 if not os.path.exists(model_dir):
     os.makedirs(model_dir)
@@ -127,11 +149,16 @@ if not os.path.exists(input_dir):
     print("Input folder not found".format(input_dir))
 
 text_fname = {"en": os.path.join(input_dir, "text.en"), "fr": os.path.join(input_dir, "text.fr")}
-bucket_data_fname = os.path.join(input_dir, "buckets_{0:d}.list")
+# bucket number, shard number
+bucket_data_fname = os.path.join(input_dir, "buckets_{0:d}_{1:d}.list")
+bucket_manifest_fname = os.path.join(input_dir, "buckets.json")
+# [start, num] line ranges of training data appended to text.* later
+appended_ranges_fname = os.path.join(input_dir, "appended.json")
 tokens_fname = os.path.join(input_dir, "tokens.list")
 vocab_path = os.path.join(input_dir, "vocab.dict")
 w2i_path = os.path.join(input_dir, "w2i.dict")
 i2w_path = os.path.join(input_dir, "i2w.dict")
+lex_table_fname = os.path.join(input_dir, "lex_table.npz")
 #---------------------------------------------------------------------
 # Model Parameters
 #---------------------------------------------------------------------
@@ -141,6 +168,8 @@ num_layers_highway = 4
 num_filters_conv = 8
 segment_size = 5
 use_attn = SOFT_ATTN
+# attention scoring: "dot", "general" (bilinear) or "additive" (Bahdanau)
+attn_score = "dot"
 #---------------------------------------------------------------------
 # !! NOTE !!
 #---------------------------------------------------------------------
@@ -153,6 +182,18 @@ create_buckets_flag = True
 #---------------------------------------------------------------------
 # Training Parameters
 #---------------------------------------------------------------------
+# if > 0, keep encoder/decoder activations only every recompute_chunk
+# timesteps and recompute the rest in backward, trading compute for memory
+recompute_chunk = 0
+# run this many batches (possibly from different buckets) before every
+# optimizer update, summing their gradients. The loss of every update
+# (and the logged loss) is normalized by the number of target tokens, so
+# runs with different settings are comparable.
+grad_accum_steps = 1
+# scheduled sampling: probability that a decoder training step is fed the
+# model's own previous prediction instead of the gold token, 0 is plain
+# teacher forcing
+sampling_ratio = 0.
 
 #---------------------------------------------------------------------
 # Training EPOCHS
@@ -166,6 +207,64 @@ NUM_EPOCHS = 1
 if NUM_EPOCHS == 0:
     NUM_DEV_SENTENCES = NUM_SENTENCES-NUM_TRAINING_SENTENCES
 
+#---------------------------------------------------------------------
+# Profiling
+#---------------------------------------------------------------------
+# time data loading, batching, encode, decode, backward and update
+# per bucket and epoch during batch training
+profile_train = True
+
+#---------------------------------------------------------------------
+# Checkpointing
+#---------------------------------------------------------------------
+# write model files from a background thread instead of blocking training
+async_checkpoint = True
+# save Adam state next to each model file, so that resuming is exact
+save_optimizer_state = True
+# number of per-epoch model files to keep, 0 keeps all of them
+keep_epoch_models = 0
+# save a resumable checkpoint (model, optimizer, data position, rng)
+# every so many optimizer updates, 0 disables step checkpoints
+checkpoint_every_batches = 200
+
+#---------------------------------------------------------------------
+# Inference
+#---------------------------------------------------------------------
+# dev BLEU and predictions decode length-sorted batches of this size,
+# 1 decodes one sentence at a time. Batches pad sources at the start (to
+# whole segments when convolutional), as in training; the padding changes
+# the encoder states, so dev BLEU differs slightly from runs decoded one
+# sentence at a time
+infer_batch_size = 32
+# memory cap (MiB) of the LRU cache of dev/prediction translations, keyed by
+# source ids and a hash of the model weights, 0 disables it
+translation_cache_mb = 64
+# storage for embeddings and output layer when only evaluating
+# (NUM_EPOCHS = 0): "float32", "float16" or "int8" (with per-row scales)
+inference_dtype = "float32"
+# export an int8 decoder (decoder LSTMs, context and output layers) and
+# compare it with float32 when only evaluating
+quantize_decoder = False
+# number of dev sentences used to calibrate the int8 input scales
+quant_calib_sentences = 100
+# report BLEU/speed when decoding over source-conditioned candidate
+# vocabularies: top_k target ids per source id from the lexical table,
+# plus the shortlist_num_frequent most frequent target ids. Word level
+# vocabularies only, skipped when CONVOLUTIONAL
+shortlist_report = False
+shortlist_top_k = [10, 50, 200]
+shortlist_num_frequent = 1000
+# export the model for the numpy runtime (nmt_runtime.py) and check it
+# against the chainer model when only evaluating
+export_runtime = False
+# number of worker processes for the runtime check; the workers mmap the
+# exported weights read-only and share them, 0 skips the parallel run
+translate_workers = 0
+# write the top align_top_k attention weights of every predicted word of
+# the dev set to align_fname (see nmt_align.py) when only evaluating
+export_alignments = False
+align_top_k = 5
+
 #---------------------------------------------------------------------
 # GPU/CPU
 #---------------------------------------------------------------------
@@ -181,8 +280,15 @@ name_to_log = "{0:d}sen_{1:d}-{2:d}layers_{3:d}units_{4:s}_{5:s}".format(
                                                             hidden_units,
                                                             EXP_NAME,
                                                             attn_post[use_attn])
+if use_attn and attn_score != "dot":
+    name_to_log += "_" + attn_score
 
 log_train_fil_name = os.path.join(model_dir, "train_{0:s}.log".format(name_to_log))
 log_dev_fil_name = os.path.join(model_dir, "dev_{0:s}.log".format(name_to_log))
+# per phase timings, written as .csv and .json
+log_profile_fil_name = os.path.join(model_dir, "profile_{0:s}".format(name_to_log))
 model_fil = os.path.join(model_dir, "seq2seq_{0:s}.model".format(name_to_log))
+quantized_model_fil = model_fil.replace(".model", "_int8.npz")
+runtime_model_fil = model_fil.replace(".model", "_runtime.npz")
+align_fname = model_fil.replace(".model", "_dev_align.npz")
 #---------------------------------------------------------------------
@@ -0,0 +1,368 @@
+# coding: utf-8
+
+# ## Corpus access helpers
+#
+# Line-offset index for the parallel text files, so that any range of
+# lines can be fetched with a single seek instead of scanning the file,
+# conversion of raw lines to vocabulary ids and length bucketing.
+#
+# Buckets are built by worker processes over contiguous shards of the
+# corpus. Every worker writes its own file per non-empty bucket, and a json
+# manifest lists the shard files of each bucket in corpus order, together
+# with content hashes of the inputs, so unchanged data is not re-bucketed.
+# Line ranges appended to the corpus later are bucketed into new shards
+# added to the same manifest.
+
+# In[ ]:
+
+import os
+import json
+import mmap
+import pickle
+import hashlib
+import multiprocessing
+import numpy as np
+
+
+# In[ ]:
+
+def index_fname(fname):
+    return fname + ".idx.npy"
+
+
+def build_line_index(fname, idx_fname=None):
+    '''
+    Store the byte offset of the start of every line, plus the file size,
+    as an int64 array. Line k spans offsets[k]:offsets[k+1].
+    '''
+    idx_fname = idx_fname or index_fname(fname)
+    offsets = [0]
+    pos = 0
+    with open(fname, "rb") as in_f:
+        for line in in_f:
+            pos += len(line)
+            offsets.append(pos)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    np.save(idx_fname, offsets)
+    print("finished indexing {0:s}, {1:d} lines".format(fname, len(offsets)-1))
+    return offsets
+
+
+def load_line_index(fname, idx_fname=None):
+    # rebuild the index if it is missing or does not match the text file
+    idx_fname = idx_fname or index_fname(fname)
+    if os.path.exists(idx_fname):
+        offsets = np.load(idx_fname, mmap_mode="r")
+        if (len(offsets) > 0 and offsets[-1] == os.path.getsize(fname) and
+                os.path.getmtime(idx_fname) >= os.path.getmtime(fname)):
+            return offsets
+    return build_line_index(fname, idx_fname)
+
+
+def extend_line_index(fname, idx_fname=None):
+    # index only the lines appended after the indexed part of the file
+    idx_fname = idx_fname or index_fname(fname)
+    if not os.path.exists(idx_fname):
+        return build_line_index(fname, idx_fname)
+    offsets = np.load(idx_fname)
+    if len(offsets) == 0 or offsets[-1] > os.path.getsize(fname):
+        return build_line_index(fname, idx_fname)
+    pos = int(offsets[-1])
+    new_offsets = []
+    with open(fname, "rb") as in_f:
+        in_f.seek(pos)
+        for line in in_f:
+            pos += len(line)
+            new_offsets.append(pos)
+    offsets = np.concatenate((offsets, np.asarray(new_offsets, dtype=np.int64)))
+    np.save(idx_fname, offsets)
+    print("finished indexing {0:s}, {1:d} new lines".format(fname, len(new_offsets)))
+    return offsets
+
+
+def load_appended_ranges(fname):
+    # [start, num] line ranges appended to the corpus as training data
+    if not os.path.exists(fname):
+        return []
+    with open(fname) as in_f:
+        return json.load(in_f)
+
+
+def save_appended_ranges(fname, ranges):
+    with open(fname + ".tmp", "w") as out_f:
+        json.dump(ranges, out_f)
+    os.replace(fname + ".tmp", fname)
+
+
+class LineReader(object):
+    '''
+    Random access to the lines of a text file through its offset index.
+    Lines are returned as raw bytes, including the trailing newline, exactly
+    as iterating over the file opened in "rb" mode would.
+    '''
+    def __init__(self, fname, idx_fname=None):
+        self.fname = fname
+        self.offsets = load_line_index(fname, idx_fname)
+        self.in_f = open(fname, "rb")
+        if len(self) > 0:
+            self.mm = mmap.mmap(self.in_f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # mmap cannot map an empty file
+            self.mm = b""
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def read_lines(self, start, num):
+        start = max(0, min(start, len(self)))
+        end = max(start, min(start + num, len(self)))
+        offsets = self.offsets[start:end+1].tolist()
+        return [self.mm[offsets[k]:offsets[k+1]] for k in range(end - start)]
+
+    def close(self):
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+        self.in_f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ParallelCorpus(object):
+    '''
+    Indexed access to the fr/en text files, e.g.:
+        with ParallelCorpus(text_fname) as corpus:
+            for line_fr, line_en in corpus.read(s, num): ...
+    '''
+    def __init__(self, fnames):
+        self.readers = {lang: LineReader(fnames[lang]) for lang in ("fr", "en")}
+
+    def __len__(self):
+        return min(len(r) for r in self.readers.values())
+
+    def read(self, start, num):
+        num = max(0, min(start + num, len(self)) - start)
+        return list(zip(self.readers["fr"].read_lines(start, num),
+                        self.readers["en"].read_lines(start, num)))
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# In[ ]:
+
+def byte_lookup_table(w2i_lang, unk_id):
+    # character mode vocabularies are keyed by byte values
+    return np.asarray([w2i_lang.get(b, unk_id) for b in range(256)], dtype=np.int32)
+
+
+class LineToIds(object):
+    '''
+    Converts a raw line (bytes) to a list of vocabulary ids. In character
+    mode every byte of the line, newline included, is looked up at once in a
+    256-entry table; in word mode the whitespace separated words are looked
+    up in w2i_lang.
+    '''
+    def __init__(self, w2i_lang, char, unk_id):
+        self.w2i = w2i_lang
+        self.char = char
+        self.unk_id = unk_id
+        self.table = byte_lookup_table(w2i_lang, unk_id) if char else None
+
+    def __call__(self, line):
+        if self.char:
+            return self.table[np.frombuffer(line, dtype=np.uint8)].tolist()
+        return [self.w2i.get(w, self.unk_id) for w in line.strip().split()]
+
+    def lines(self, lines):
+        # one table lookup for a whole list of lines in character mode
+        if not self.char:
+            return [self(line) for line in lines]
+        ids = self.table[np.frombuffer(b"".join(lines), dtype=np.uint8)]
+        ends = np.cumsum([len(line) for line in lines])
+        return [a.tolist() for a in np.split(ids, ends[:-1])] if lines else []
+
+
+# In[ ]:
+
+def bucket_index(src_len, tgt_len, src_width, num_src, tgt_width, num_tgt):
+    # flat index of the (source bin, target bin) bucket
+    src_bin = min((src_len - 1) // src_width, num_src - 1)
+    tgt_bin = min((tgt_len - 1) // tgt_width, num_tgt - 1)
+    return src_bin * num_tgt + tgt_bin
+
+
+def assign_buckets(id_pairs, src_width, num_src, tgt_width, num_tgt):
+    '''
+    Split (src_ids, tgt_ids) pairs into num_src * num_tgt buckets by source
+    and target length. Each side is truncated to the limit of its last bin;
+    pairs with an empty side are dropped.
+    '''
+    src_max, tgt_max = src_width * num_src, tgt_width * num_tgt
+    buckets = [[] for _ in range(num_src * num_tgt)]
+    for src_ids, tgt_ids in id_pairs:
+        if len(src_ids) > 0 and len(tgt_ids) > 0:
+            src_ids, tgt_ids = src_ids[:src_max], tgt_ids[:tgt_max]
+            buck_indx = bucket_index(len(src_ids), len(tgt_ids),
+                                     src_width, num_src, tgt_width, num_tgt)
+            buckets[buck_indx].append((src_ids, tgt_ids))
+    return buckets
+
+
+def batch_pad_lims(batch, src_multiple=1):
+    # pad a batch only to its longest source and target, the source rounded
+    # up to a multiple of src_multiple (the convolution segment size)
+    src_lim = max(len(src) for src, _ in batch)
+    tgt_lim = max(len(tgt) for _, tgt in batch)
+    return -(-src_lim // src_multiple) * src_multiple, tgt_lim
+
+
+# In[ ]:
+
+def file_digest(fname, chunk_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(fname, "rb") as in_f:
+        for chunk in iter(lambda: in_f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def bucket_key(text_fnames, vocab_fname, params):
+    # everything the bucket contents depend on
+    return {"text": {lang: file_digest(fname) for lang, fname in sorted(text_fnames.items())},
+            "vocab": file_digest(vocab_fname),
+            "params": params}
+
+
+def load_manifest(manifest_fname):
+    if not os.path.exists(manifest_fname):
+        return None
+    with open(manifest_fname) as in_f:
+        manifest = json.load(in_f)
+    manifest["dir"] = os.path.dirname(os.path.abspath(manifest_fname))
+    return manifest
+
+
+def save_manifest(manifest_fname, manifest):
+    manifest = {k: v for k, v in manifest.items() if k != "dir"}
+    tmp_fname = manifest_fname + ".tmp"
+    with open(tmp_fname, "w") as out_f:
+        json.dump(manifest, out_f, indent=1)
+    os.replace(tmp_fname, manifest_fname)
+
+
+def bucket_files(manifest, buck_indx):
+    return [os.path.join(manifest["dir"], shard["file"]) for shard in manifest["buckets"][buck_indx]]
+
+
+def manifest_complete(manifest):
+    return all(os.path.exists(fname) for k in range(len(manifest["buckets"]))
+               for fname in bucket_files(manifest, k))
+
+
+def load_bucket(manifest, buck_indx, first_range=0):
+    # pairs of a bucket, shards in corpus order; with first_range > 0 only
+    # those of manifest["ranges"][first_range:]
+    bucket = []
+    for shard in manifest["buckets"][buck_indx]:
+        if shard.get("range", 0) >= first_range:
+            with open(os.path.join(manifest["dir"], shard["file"]), "rb") as in_f:
+                bucket += pickle.load(in_f)
+    return bucket
+
+
+# one pair of converters per worker process
+_shard_line_to_ids = None
+
+
+def _init_bucket_worker(w2i, char, unk_id):
+    global _shard_line_to_ids
+    _shard_line_to_ids = {lang: LineToIds(w2i[lang], char, unk_id) for lang in ("fr", "en")}
+
+
+def _bucket_shard(args):
+    fnames, shard, start, num, bucket_params, shard_fname, chunk_size = args
+    buckets = None
+    with ParallelCorpus(fnames) as corpus:
+        for chunk_start in range(start, start + num, chunk_size):
+            lines = corpus.read(chunk_start, min(chunk_size, start + num - chunk_start))
+            pairs = zip(_shard_line_to_ids["fr"].lines([fr for fr, _ in lines]),
+                        _shard_line_to_ids["en"].lines([en for _, en in lines]))
+            chunk_buckets = assign_buckets(pairs, *bucket_params)
+            if buckets is None:
+                buckets = chunk_buckets
+            else:
+                for bucket, chunk_bucket in zip(buckets, chunk_buckets):
+                    bucket += chunk_bucket
+    shards = []
+    for k, bucket in enumerate(buckets or []):
+        if bucket:
+            fname = shard_fname.format(k+1, shard)
+            with open(fname, "wb") as out_f:
+                pickle.dump(bucket, out_f)
+            shards.append((k, os.path.basename(fname), len(bucket)))
+    return shards
+
+
+def create_bucket_shards(fnames, ranges, w2i, char, unk_id, bucket_params,
+                         shard_fname, manifest_fname, key, workers=1, chunk_size=50000,
+                         append=False):
+    '''
+    Bucket the pairs in the [start, num] line ranges of fnames with
+    assign_buckets over `workers` processes, each taking a contiguous shard,
+    and write the manifest.
+        bucket_params: (src_width, num_src, tgt_width, num_tgt)
+        shard_fname:   format string for (bucket number, shard number)
+        append:        add the ranges to the existing manifest and shards
+    '''
+    old_manifest = load_manifest(manifest_fname)
+    if old_manifest and not append:
+        # shard files of a previous run are replaced
+        for k in range(len(old_manifest["buckets"])):
+            for fname in bucket_files(old_manifest, k):
+                if os.path.exists(fname):
+                    os.remove(fname)
+    num_buckets = bucket_params[1] * bucket_params[3]
+    if append:
+        manifest = old_manifest
+    else:
+        manifest = {"buckets": [[] for _ in range(num_buckets)], "ranges": [], "num_shards": 0}
+
+    with ParallelCorpus(fnames) as corpus:
+        ranges = [[start, max(0, min(num, len(corpus) - start))] for start, num in ranges]
+    num_lines = sum(num for _, num in ranges)
+    workers = max(1, min(workers, num_lines))
+    shard_size = max(1, -(-num_lines // workers))
+    jobs, shard_ranges = [], []
+    for range_indx, (start, num) in enumerate(ranges, start=len(manifest["ranges"])):
+        for shard_start in range(start, start + num, shard_size):
+            jobs.append((fnames, manifest["num_shards"] + len(jobs), shard_start,
+                         min(shard_size, start + num - shard_start), bucket_params,
+                         shard_fname, chunk_size))
+            shard_ranges.append(range_indx)
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=_init_bucket_worker,
+                                  initargs=(w2i, char, unk_id)) as pool:
+            results = pool.map(_bucket_shard, jobs)
+    else:
+        _init_bucket_worker(w2i, char, unk_id)
+        results = [_bucket_shard(job) for job in jobs]
+
+    for shards, range_indx in zip(results, shard_ranges):
+        for k, fname, count in shards:
+            manifest["buckets"][k].append({"file": fname, "count": count, "range": range_indx})
+    manifest["key"] = key
+    manifest["ranges"] += ranges
+    manifest["num_shards"] += len(jobs)
+    save_manifest(manifest_fname, manifest)
+    return load_manifest(manifest_fname)
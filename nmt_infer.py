@@ -0,0 +1,199 @@
+# coding: utf-8
+
+# ## Batched inference
+#
+# Sentences are sorted by source length and cut into batches that stay
+# within one bucket of BUCKET_WIDTH, so that batched decoding wastes little
+# work on padding. Predictions are returned in the original order.
+#
+# Subtitles repeat many short lines exactly, so translations can be memoized
+# in a TranslationCache keyed by the source ids and a fingerprint of the
+# model weights; repeated sources within one call are decoded once.
+
+# In[ ]:
+
+import sys
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from chainer import cuda
+
+
+# In[ ]:
+
+def length_batches(id_lists, bucket_width, batch_size):
+    '''
+    Return lists of indices into id_lists, each holding at most batch_size
+    sentences whose source lengths fall in the same bucket.
+    '''
+    order = sorted(range(len(id_lists)), key=lambda k: len(id_lists[k]))
+    batches = []
+    curr_batch, curr_bucket = [], None
+    for k in order:
+        buck_indx = (max(len(id_lists[k]), 1) - 1) // bucket_width
+        if curr_batch and (buck_indx != curr_bucket or len(curr_batch) == batch_size):
+            batches.append(curr_batch)
+            curr_batch = []
+        curr_batch.append(k)
+        curr_bucket = buck_indx
+    if curr_batch:
+        batches.append(curr_batch)
+    return batches
+
+
+def padding_efficiency(id_lists, batches):
+    # real source tokens / source positions actually encoded
+    real, padded = 0, 0
+    for batch in batches:
+        lens = [len(id_lists[k]) for k in batch]
+        real += sum(lens)
+        padded += max(1, max(lens)) * len(batch)
+    return real / padded if padded else 1.
+
+
+def translate_batched(model, id_lists, batch_size, bucket_width,
+                      max_predict_len=20, shortlister=None, progress=None,
+                      cache=None, fingerprint=None):
+    '''
+    Decode id_lists with model.encode_decode_predict_batch.
+        shortlister: optional nmt_shortlist.Shortlister, applied per batch
+        progress:    optional callable, called with the size of each batch
+        cache:       optional TranslationCache, with the fingerprint of the
+                     model (see model_fingerprint). Not used with a
+                     shortlister, whose candidates depend on the batch.
+    Every distinct source is decoded once; repeats of a source within the
+    call count as cache hits. A prediction depends on the length the
+    source is padded to in its batch, so that length is part of the cache
+    key, and the misses of a batch are decoded padded to the same length.
+    Returns the predictions in input order and the batching statistics.
+    '''
+    if shortlister:
+        cache = None
+    predictions = [None] * len(id_lists)
+    # first sentence with each distinct source, repeats share its prediction
+    first = OrderedDict()
+    duplicates = 0
+    for k, src in enumerate(id_lists):
+        src = tuple(src)
+        if src in first:
+            duplicates += 1
+            if cache is not None:
+                cache.record_hit()
+        else:
+            first[src] = k
+    if progress and duplicates:
+        progress(duplicates)
+
+    distinct = list(first.values())
+    src_lists = [id_lists[k] for k in distinct]
+    batches = length_batches(src_lists, bucket_width, batch_size)
+    decoded = 0
+    for batch in batches:
+        batch_srcs = [src_lists[j] for j in batch]
+        src_lim = model.predict_src_lim(batch_srcs)
+        keys = [cache_key(fingerprint, src, "batch", max_predict_len, src_lim)
+                for src in batch_srcs]
+        batch_preds = [cache.get(key) if cache is not None else None for key in keys]
+        todo = [r for r, pred in enumerate(batch_preds) if pred is None]
+        if todo:
+            todo_srcs = [batch_srcs[r] for r in todo]
+            shortlist = shortlister(todo_srcs) if shortlister else None
+            todo_preds = model.encode_decode_predict_batch(todo_srcs, max_predict_len,
+                                                           shortlist, src_lim)
+            for r, pred in zip(todo, todo_preds):
+                batch_preds[r] = pred
+                if cache is not None:
+                    cache.put(keys[r], pred)
+            decoded += len(todo)
+        for j, pred in zip(batch, batch_preds):
+            predictions[distinct[j]] = pred
+        if progress:
+            progress(len(batch))
+
+    for k, src in enumerate(id_lists):
+        if predictions[k] is None:
+            predictions[k] = predictions[first[tuple(src)]]
+    stats = {"sentences": len(id_lists), "decoded": decoded, "duplicates": duplicates,
+             "batches": len(batches),
+             "padding_efficiency": padding_efficiency(src_lists, batches)}
+    return predictions, stats
+
+
+# In[ ]:
+
+def model_fingerprint(model):
+    # hash of all weights, including the compressed inference copies
+    digest = hashlib.sha1()
+    for name, param in sorted(model.namedparams(), key=lambda p: p[0]):
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(cuda.to_cpu(param.data)).tobytes())
+    for name in sorted(getattr(model, "compressed", {})):
+        for arr in model.compressed[name]:
+            if arr is not None:
+                digest.update(np.ascontiguousarray(cuda.to_cpu(arr)).tobytes())
+    return digest.hexdigest()
+
+
+def cache_key(fingerprint, src_ids, *settings):
+    return (fingerprint,) + settings + (tuple(src_ids),)
+
+
+class TranslationCache(object):
+    '''
+    LRU cache of predicted id lists. Keys come from cache_key, so entries
+    of an older model are never returned and just age out. The least
+    recently used entries are dropped while the estimated size of the
+    entries is above max_bytes.
+    '''
+    def __init__(self, max_bytes=64 * 2**20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def entry_nbytes(key, value):
+        # containers plus one int object per id
+        return (sys.getsizeof(key) + sys.getsizeof(key[-1]) + sys.getsizeof(value)
+                + 28 * (len(key[-1]) + len(value)))
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def record_hit(self):
+        # a lookup answered without the cache, e.g. a repeat within a call
+        self.hits += 1
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.nbytes -= self.entry_nbytes(key, self.entries.pop(key))
+        self.entries[key] = value
+        self.nbytes += self.entry_nbytes(key, value)
+        while self.nbytes > self.max_bytes and self.entries:
+            old_key, old_value = self.entries.popitem(last=False)
+            self.nbytes -= self.entry_nbytes(old_key, old_value)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.,
+                "entries": len(self.entries), "bytes": self.nbytes}
+
+
+def cached_predict(predict_fn, cache, fingerprint, max_predict_len=20):
+    # per sentence predict_fn (source ids -> predicted ids) through cache
+    def predict(src_ids):
+        key = cache_key(fingerprint, src_ids, "sentence", max_predict_len)
+        pred = cache.get(key)
+        if pred is None:
+            pred = predict_fn(src_ids)
+            cache.put(key, pred)
+        return pred
+    return predict
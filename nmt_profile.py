@@ -0,0 +1,108 @@
+# coding: utf-8
+
+# ## Training profiler
+#
+# Wall-clock time per training phase, aggregated per epoch and bucket, with
+# sentence/token counts for throughput.
+
+# In[ ]:
+
+import csv
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# In[ ]:
+
+class PhaseProfiler(object):
+    '''
+    Usage:
+        profiler.set_context(epoch, bucket)
+        with profiler.phase("encode"):
+            ...
+        profiler.add_batch(num_sentences, src_tokens, tgt_tokens)
+    Phases should not be nested, so that their times add up to the total.
+    '''
+    def __init__(self):
+        self.epoch = 0
+        self.bucket = 0
+        # (epoch, bucket, phase) -> [calls, seconds]
+        self.times = OrderedDict()
+        # (epoch, bucket) -> [batches, sentences, src tokens, tgt tokens]
+        self.counts = OrderedDict()
+
+    def set_context(self, epoch, bucket):
+        self.epoch = epoch
+        self.bucket = bucket
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = self.times.setdefault((self.epoch, self.bucket, name), [0, 0.])
+            entry[0] += 1
+            entry[1] += time.perf_counter() - start
+
+    def add_batch(self, sentences, src_tokens, tgt_tokens):
+        entry = self.counts.setdefault((self.epoch, self.bucket), [0, 0, 0, 0])
+        entry[0] += 1
+        entry[1] += sentences
+        entry[2] += src_tokens
+        entry[3] += tgt_tokens
+
+    def rows(self):
+        # one row per (epoch, bucket, phase)
+        bucket_time = {}
+        for (epoch, bucket, name), (calls, secs) in self.times.items():
+            bucket_time[(epoch, bucket)] = bucket_time.get((epoch, bucket), 0.) + secs
+        rows = []
+        for (epoch, bucket, name), (calls, secs) in self.times.items():
+            total = bucket_time[(epoch, bucket)]
+            batches, sents, src_toks, tgt_toks = self.counts.get((epoch, bucket), [0, 0, 0, 0])
+            rows.append(OrderedDict([
+                ("epoch", epoch), ("bucket", bucket), ("phase", name),
+                ("calls", calls), ("seconds", secs),
+                ("ms_per_call", 1000. * secs / calls if calls else 0.),
+                ("share", secs / total if total else 0.),
+                ("batches", batches), ("sentences", sents),
+                ("src_tokens", src_toks), ("tgt_tokens", tgt_toks),
+                ("sentences_per_sec", sents / total if total else 0.),
+                ("tokens_per_sec", (src_toks + tgt_toks) / total if total else 0.)]))
+        return rows
+
+    def epoch_summary(self, epoch):
+        # phase -> seconds, summed over all buckets of the epoch
+        summary = OrderedDict()
+        for (e, bucket, name), (calls, secs) in self.times.items():
+            if e == epoch:
+                summary[name] = summary.get(name, 0.) + secs
+        return summary
+
+    def write_csv(self, fname):
+        rows = self.rows()
+        with open(fname, "w") as out_f:
+            if rows:
+                writer = csv.DictWriter(out_f, fieldnames=list(rows[0].keys()),
+                                        lineterminator="\n")
+                writer.writeheader()
+                writer.writerows(rows)
+
+    def write_json(self, fname):
+        epochs = sorted(set(e for e, _, _ in self.times))
+        with open(fname, "w") as out_f:
+            json.dump({"phases": self.rows(),
+                       "epochs": {str(e): self.epoch_summary(e) for e in epochs}},
+                      out_f, indent=1)
+
+    def print_summary(self, epoch):
+        summary = self.epoch_summary(epoch)
+        total = sum(summary.values())
+        print("{0:s}".format("-"*50))
+        for name, secs in summary.items():
+            print("{0:10s} | {1:10.2f}s | {2:5.1f}%".format(name, secs,
+                  100. * secs / total if total else 0.))
+        print("{0:s}".format("-"*50))
@@ -0,0 +1,180 @@
+# coding: utf-8
+
+# ## Post-training int8 quantization of the decoder
+#
+# The decoder LSTM layers, the attention context layer and the output layer
+# are exported with int8 weights (one float32 scale per output row). The
+# inputs of each layer are quantized with a per-layer scale calibrated on
+# dev sentences, and the matmuls accumulate the int8 products exactly in
+# int32. The encoder, including the encoder side of the attention scores, still runs in
+# float32 through chainer; training is unchanged.
+
+# In[ ]:
+
+import functools
+import numpy as np
+from chainer import cuda
+
+from nmt_config import EOS_ID, PAD_ID, GO_ID
+from nmt_runtime import softmax, lstm_cell
+
+
+# In[ ]:
+
+def quantize_rows(W):
+    scale = np.abs(W).max(axis=1) / 127.
+    scale[scale == 0] = 1.
+    return np.rint(W / scale[:, None]).astype(np.int8), scale.astype(np.float32)
+
+
+def quantize_input(x, scale):
+    return np.clip(np.rint(x / scale), -127, 127).astype(np.int8)
+
+
+def int8_matmul(x_q, W_q):
+    '''
+    x_q (batch, k) times W_q.T (k, n), both int8, accumulated in int32.
+    einsum casts the int8 operands in small buffers while it sums, so no
+    upcast copy of W_q is made (a dot or matmul with dtype=np.int32 would
+    convert all of it, or fall back to a much slower loop).
+    '''
+    return np.einsum("bk,nk->bn", x_q, W_q, dtype=np.int32).astype(np.float32)
+
+
+def decoder_nbytes(arrays):
+    # memory held by the decoder arrays
+    return sum(np.asarray(v).nbytes for v in arrays.values())
+
+
+def linear_names(n_layers, attn, attn_score="dot"):
+    names = []
+    for k in range(n_layers):
+        names += ["L{0:d}_dec/upward".format(k), "L{0:d}_dec/lateral".format(k)]
+    if attn:
+        if attn_score == "additive":
+            names += ["attn_dec", "attn_v"]
+        names.append("context")
+    names.append("out")
+    return names
+
+
+def float_arrays(model):
+    # float32 decoder weights of a chainer EncoderDecoder
+    arrays = {"embed_dec/W": cuda.to_cpu(model.embed_dec.W.data),
+              "n_layers": np.asarray(len(model.lstm_dec)),
+              "attn": np.asarray(int(model.attn)),
+              "attn_score": np.asarray(model.attn_score)}
+    for name in linear_names(len(model.lstm_dec), model.attn, model.attn_score):
+        link = functools.reduce(getattr, name.split("/"), model)
+        arrays[name + "/W"] = cuda.to_cpu(link.W.data)
+        if link.b is not None:
+            arrays[name + "/b"] = cuda.to_cpu(link.b.data)
+    return arrays
+
+
+# In[ ]:
+
+class QuantizedDecoder(object):
+    '''
+    Greedy decoder over exported arrays, int8 (from export_quantized) or
+    float32 (from float_arrays). With calibrate=True the largest input
+    magnitude of every layer is recorded in max_abs.
+    '''
+    def __init__(self, arrays, calibrate=False):
+        self.arrays = arrays
+        self.n_layers = int(arrays["n_layers"])
+        self.attn = bool(arrays["attn"])
+        self.attn_score = str(arrays["attn_score"]) if "attn_score" in arrays else "dot"
+        self.max_abs = {} if calibrate else None
+
+    def linear(self, name, x):
+        b = self.arrays.get(name + "/b")
+        if self.max_abs is not None:
+            self.max_abs[name] = max(self.max_abs.get(name, 0.), float(np.abs(x).max()))
+        if name + "/W_q" in self.arrays:
+            x_scale = self.arrays[name + "/x_scale"]
+            acc = int8_matmul(quantize_input(x, x_scale), self.arrays[name + "/W_q"])
+            y = acc * (x_scale * self.arrays[name + "/w_scale"])
+        else:
+            y = x.dot(self.arrays[name + "/W"].T)
+        if b is not None:
+            y += b
+        return y
+
+    def predict(self, enc_states, c0, h0, max_predict_len=20, keys=None):
+        '''
+        enc_states: (seq, 2*units) encoder states
+        c0, h0:     initial state of the first decoder layer
+        keys:       encoder side of the attention scores, enc_states if None
+        '''
+        keys = enc_states if keys is None else keys
+        c = [c0] + [np.zeros_like(c0) for _ in range(self.n_layers - 1)]
+        h = [h0] + [np.zeros_like(h0) for _ in range(self.n_layers - 1)]
+        predicted_sent = []
+        pred_word = GO_ID
+        while len(predicted_sent) < max_predict_len:
+            x = self.arrays["embed_dec/W"][[pred_word]]
+            for k in range(self.n_layers):
+                gates = (self.linear("L{0:d}_dec/upward".format(k), x) +
+                         self.linear("L{0:d}_dec/lateral".format(k), h[k]))
+                c[k], h[k] = lstm_cell(gates, c[k])
+                x = h[k]
+            if self.attn:
+                if self.attn_score == "additive":
+                    e = np.tanh(keys + self.linear("attn_dec", x))
+                    alphas = softmax(self.linear("attn_v", e).T)
+                else:
+                    alphas = softmax(x.dot(keys.T))
+                cv = alphas.dot(enc_states)
+                x = np.tanh(self.linear("context", np.concatenate((cv, x), axis=1)))
+            pred_word = int(np.argmax(self.linear("out", x)[0]))
+            predicted_sent.append(pred_word)
+            if pred_word == EOS_ID or pred_word == PAD_ID:
+                break
+        return predicted_sent
+
+
+# In[ ]:
+
+def quantized_predict(model, qdec, in_word_list, max_predict_len=20):
+    # encode with the float chainer model, decode with the int8 decoder
+    model.reset_state()
+    model.encode_list(in_word_list, train=False)
+    model.set_decoder_state()
+    first_dec = model[model.lstm_dec[0]]
+    keys = cuda.to_cpu(model.attn_keys.data) if model.attn else None
+    return qdec.predict(cuda.to_cpu(model.enc_states.data),
+                        cuda.to_cpu(first_dec.c.data), cuda.to_cpu(first_dec.h.data),
+                        max_predict_len, keys)
+
+
+def quantized_arrays(model, calib_id_lists, max_predict_len=20):
+    '''
+    Calibrate input scales by decoding calib_id_lists with the float
+    weights, and return the int8 decoder arrays.
+    '''
+    f_arrays = float_arrays(model)
+    calib_dec = QuantizedDecoder(f_arrays, calibrate=True)
+    for in_word_list in calib_id_lists:
+        quantized_predict(model, calib_dec, in_word_list, max_predict_len)
+
+    arrays = {k: f_arrays[k] for k in ("embed_dec/W", "n_layers", "attn", "attn_score")}
+    for name in linear_names(len(model.lstm_dec), model.attn, model.attn_score):
+        arrays[name + "/W_q"], arrays[name + "/w_scale"] = quantize_rows(f_arrays[name + "/W"])
+        arrays[name + "/x_scale"] = np.float32(max(calib_dec.max_abs.get(name, 1.), 1e-8) / 127.)
+        if name + "/b" in f_arrays:
+            arrays[name + "/b"] = f_arrays[name + "/b"]
+    return arrays
+
+
+def export_quantized(model, calib_id_lists, fname, max_predict_len=20):
+    # write the int8 decoder to fname (.npz)
+    arrays = quantized_arrays(model, calib_id_lists, max_predict_len)
+    with open(fname, "wb") as out_f:
+        np.savez(out_f, **arrays)
+    print("finished exporting int8 decoder: {0:s}".format(fname))
+
+
+def load_quantized(fname):
+    with np.load(fname) as npz:
+        return QuantizedDecoder({k: npz[k] for k in npz.files})
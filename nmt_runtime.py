@@ -0,0 +1,318 @@
+# coding: utf-8
+
+# ## Frozen model and numpy runtime
+#
+# export_model writes the weights and the architecture of an EncoderDecoder
+# into a single .npz file. NumpyEncoderDecoder runs the same encoder,
+# attention and decoder from that file with numpy only, so translation
+# workers do not need chainer, nmt_config or the vocabulary pickles to load
+# a model.
+#
+# The .npz is written uncompressed, so load_runtime(fname, mmap=True) can map
+# every array read-only straight from the file. Worker processes started by
+# translate_parallel all map the same file and share its pages through the
+# OS page cache instead of each holding a private copy of the weights.
+
+# In[ ]:
+
+import json
+import zipfile
+import multiprocessing
+import numpy as np
+
+
+# In[ ]:
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def log_softmax(x):
+    x = x - x.max(axis=-1, keepdims=True)
+    return x - np.log(np.exp(x).sum(axis=-1, keepdims=True))
+
+
+def lstm_cell(gates, c_prev):
+    # same gate layout as chainer.functions.lstm: (a, i, f, o) interleaved
+    r = gates.reshape((gates.shape[0], gates.shape[1] // 4, 4))
+    a, i, f, o = np.tanh(r[:, :, 0]), sigmoid(r[:, :, 1]), sigmoid(r[:, :, 2]), sigmoid(r[:, :, 3])
+    c = a * i + f * c_prev
+    return c, o * np.tanh(c)
+
+
+def to_cpu(a):
+    # cupy arrays have .get(), numpy arrays do not
+    return a.get() if hasattr(a, "get") else np.asarray(a)
+
+
+# In[ ]:
+
+def model_meta(model):
+    return {"vsize_enc": model.embed_enc.W.data.shape[0],
+            "vsize_dec": model.out.W.data.shape[0],
+            "nlayers_enc": len(model.lstm_enc),
+            "nlayers_dec": len(model.lstm_dec),
+            "nlayers_highway": len(model.highway) if model.convolutional else 0,
+            "n_units": model.n_units,
+            "attn": int(model.attn),
+            "attn_score": model.attn_score,
+            "convolutional": bool(model.convolutional),
+            "segment_size": model.segment_size,
+            "n_filters": model.n_filters,
+            # special ids, so that the runtime does not need nmt_config
+            "GO_ID": 1, "EOS_ID": 2, "PAD_ID": 0}
+
+
+def export_model(model, fname):
+    '''
+    Write all parameters of model, keyed by their link path, and the
+    architecture as a json string under "meta".
+    '''
+    if model.compressed:
+        raise ValueError("export the model before compress_for_inference")
+    arrays = {path.lstrip("/"): to_cpu(param.data) for path, param in model.namedparams()}
+    arrays["meta"] = np.asarray(json.dumps(model_meta(model)))
+    with open(fname, "wb") as out_f:
+        np.savez(out_f, **arrays)
+    print("finished exporting model: {0:s}".format(fname))
+
+
+def mmap_npz(fname):
+    '''
+    Read-only np.memmap views of the arrays of an uncompressed .npz file
+    (as written by np.savez). 0-d arrays are read into memory.
+    '''
+    arrays = {}
+    with zipfile.ZipFile(fname) as zf, open(fname, "rb") as in_f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError("{0:s} is compressed, cannot mmap".format(info.filename))
+            # member data follows the local file header
+            in_f.seek(info.header_offset)
+            header = in_f.read(30)
+            name_len = int.from_bytes(header[26:28], "little")
+            extra_len = int.from_bytes(header[28:30], "little")
+            in_f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(in_f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(in_f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(in_f)
+            key = info.filename[:-len(".npy")]
+            if shape == () or dtype.hasobject:
+                arrays[key] = np.load(zf.open(info.filename), allow_pickle=False)
+            else:
+                arrays[key] = np.memmap(fname, dtype=dtype, mode="r", shape=shape,
+                                        order="F" if fortran_order else "C",
+                                        offset=in_f.tell())
+    return arrays
+
+
+def load_runtime(fname, mmap=False):
+    if mmap:
+        return NumpyEncoderDecoder(mmap_npz(fname))
+    with np.load(fname) as npz:
+        arrays = {k: npz[k] for k in npz.files}
+    return NumpyEncoderDecoder(arrays)
+
+
+# In[ ]:
+
+class NumpyEncoderDecoder(object):
+    '''
+    Inference-only counterpart of enc_dec_batch.EncoderDecoder, for one
+    sentence at a time (as in encode_decode_predict).
+    '''
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.meta = json.loads(str(arrays["meta"]))
+        m = self.meta
+        self.lstm_enc = ["L{0:d}_enc".format(i) for i in range(m["nlayers_enc"])]
+        self.lstm_rev_enc = ["L{0:d}_rev_enc".format(i) for i in range(m["nlayers_enc"])]
+        self.lstm_dec = ["L{0:d}_dec".format(i) for i in range(m["nlayers_dec"])]
+        self.conv_enc = ["L{0:d}_conv".format(i) for i in range(m["n_filters"] or 0)]
+        self.highway = ["L{0:d}_hw".format(i) for i in range(m["nlayers_highway"])]
+
+    def linear(self, name, x):
+        y = x.dot(self.arrays[name + "/W"].T)
+        if name + "/b" in self.arrays:
+            y += self.arrays[name + "/b"]
+        return y
+
+    def lstm(self, name, x, state):
+        c, h = state
+        gates = self.linear(name + "/upward", x) + self.linear(name + "/lateral", h)
+        return lstm_cell(gates, c)
+
+    def feed_lstm(self, x, lstm_layer_list, states):
+        # states: list of (c, h) per layer, updated in place
+        hs = x
+        for k, lstm_name in enumerate(lstm_layer_list):
+            states[k] = self.lstm(lstm_name, hs, states[k])
+            hs = states[k][1]
+        return hs
+
+    def zero_states(self, lstm_layer_list, batch_size=1):
+        states = []
+        for lstm_name in lstm_layer_list:
+            size = self.arrays[lstm_name + "/lateral/W"].shape[1]
+            zeros = np.zeros((batch_size, size), dtype=np.float32)
+            states.append((zeros, zeros))
+        return states
+
+    def convolution_embed(self, src_ids):
+        # (seq, units) embeddings -> (segments, filters) phrase embeddings
+        emb = self.arrays["embed_enc/W"][src_ids]
+        seq_len = len(src_ids)
+        filters = []
+        for i, conv_name in enumerate(self.conv_enc):
+            K = self.arrays[conv_name + "/W"][0, 0]
+            padded = np.pad(emb, ((i // 2, (i + 1) // 2), (0, 0)), "constant")
+            conv = sum(padded[r:r+seq_len].dot(K[r]) for r in range(i + 1))
+            filters.append(conv + self.arrays[conv_name + "/b"][0])
+        conv = np.maximum(np.stack(filters), 0)
+        # max pooling over segments, the last one may be shorter
+        seg = self.meta["segment_size"]
+        num_seg = -(-seq_len // seg)
+        conv = np.pad(conv, ((0, 0), (0, num_seg * seg - seq_len)), "constant",
+                      constant_values=-np.inf)
+        phrase = conv.reshape((len(filters), num_seg, seg)).max(axis=2).T
+        for hw_name in self.highway:
+            plain = np.maximum(self.linear(hw_name + "/plain", phrase), 0)
+            transform = sigmoid(self.linear(hw_name + "/transform", phrase))
+            phrase = plain * transform + phrase * (1 - transform)
+        return phrase.astype(np.float32)
+
+    def encode(self, src_ids):
+        '''
+        Returns the (seq, 2*units) encoder states and the initial decoder
+        states.
+        '''
+        src_ids = np.asarray(src_ids, dtype=np.int32)
+        if self.meta["convolutional"]:
+            inputs = self.convolution_embed(src_ids)
+        else:
+            inputs = self.arrays["embed_enc/W"][src_ids]
+        fwd_states = self.zero_states(self.lstm_enc)
+        rev_states = self.zero_states(self.lstm_rev_enc)
+        fwd_hs, rev_hs = [], []
+        for t in range(len(inputs)):
+            fwd_hs.append(self.feed_lstm(inputs[[t]], self.lstm_enc, fwd_states))
+            rev_hs.append(self.feed_lstm(inputs[[len(inputs)-1-t]], self.lstm_rev_enc, rev_states))
+        enc_states = np.concatenate((np.concatenate(fwd_hs, axis=0),
+                                     np.concatenate(rev_hs[::-1], axis=0)), axis=1)
+        # first decoder layer starts from the last states of both directions
+        dec_states = self.zero_states(self.lstm_dec)
+        dec_states[0] = (np.concatenate((fwd_states[-1][0], rev_states[-1][0]), axis=1),
+                         np.concatenate((fwd_states[-1][1], rev_states[-1][1]), axis=1))
+        return enc_states, dec_states
+
+    def attention_keys(self, enc_states):
+        # encoder side of the attention scores, computed once per sentence
+        score = self.meta.get("attn_score", "dot")
+        if score == "general":
+            return self.linear("attn_general", enc_states)
+        if score == "additive":
+            return self.linear("attn_enc", enc_states)
+        return enc_states
+
+    def attention_scores(self, hs, keys):
+        if self.meta.get("attn_score", "dot") == "additive":
+            e = np.tanh(keys[None, :, :] + self.linear("attn_dec", hs)[:, None, :])
+            return self.linear("attn_v", e)[:, :, 0]
+        return hs.dot(keys.T)
+
+    def decode_step(self, words, dec_states, enc_states, keys):
+        # words: (beam,) ids, returns (beam, vocab) scores and the attention
+        hs = self.feed_lstm(self.arrays["embed_dec/W"][words], self.lstm_dec, dec_states)
+        alphas = None
+        if self.meta["attn"]:
+            alphas = softmax(self.attention_scores(hs, keys))
+            cv = alphas.dot(enc_states)
+            hs = np.tanh(self.linear("context", np.concatenate((cv, hs), axis=1)))
+        return self.linear("out", hs), alphas
+
+    def predict_greedy(self, src_ids, max_predict_len=20):
+        enc_states, dec_states = self.encode(src_ids)
+        keys = self.attention_keys(enc_states)
+        predicted_sent = []
+        pred_word = self.meta["GO_ID"]
+        while len(predicted_sent) < max_predict_len:
+            scores, _ = self.decode_step([pred_word], dec_states, enc_states, keys)
+            pred_word = int(np.argmax(scores[0]))
+            predicted_sent.append(pred_word)
+            if pred_word in (self.meta["EOS_ID"], self.meta["PAD_ID"]):
+                break
+        return predicted_sent
+
+    def predict_beam(self, src_ids, beam_size=5, max_predict_len=20):
+        '''
+        Beam search over summed log probabilities. Hypotheses end at EOS or
+        PAD; returns the best finished one (or the best unfinished one after
+        max_predict_len steps).
+        '''
+        enc_states, dec_states = self.encode(src_ids)
+        keys = self.attention_keys(enc_states)
+        end_ids = (self.meta["EOS_ID"], self.meta["PAD_ID"])
+        beams = [[]]
+        beam_scores = np.zeros(1, dtype=np.float32)
+        words = [self.meta["GO_ID"]]
+        finished = []
+        for _ in range(max_predict_len):
+            scores, _ = self.decode_step(words, dec_states, enc_states, keys)
+            cand = (beam_scores[:, None] + log_softmax(scores)).ravel()
+            top = np.argsort(-cand, kind="stable")[:beam_size]
+            rows, next_words = top // scores.shape[1], top % scores.shape[1]
+            keep = []
+            for k, (row, w) in enumerate(zip(rows, next_words)):
+                if w in end_ids:
+                    finished.append((float(cand[top[k]]), beams[row] + [int(w)]))
+                else:
+                    keep.append(k)
+            # stop when no open hypothesis can beat the best finished one
+            if not keep or (finished and max(f[0] for f in finished) >= cand[top[keep[0]]]):
+                break
+            rows, next_words = rows[keep], next_words[keep]
+            beams = [beams[row] + [int(w)] for row, w in zip(rows, next_words)]
+            beam_scores = cand[top[keep]]
+            dec_states = [(c[rows], h[rows]) for c, h in dec_states]
+            words = next_words
+        if finished:
+            return max(finished, key=lambda f: f[0])[1]
+        return beams[0]
+
+
+# In[ ]:
+
+# one mmapped runtime per worker process
+_worker_runtime = None
+
+
+def _init_worker(fname):
+    global _worker_runtime
+    _worker_runtime = load_runtime(fname, mmap=True)
+
+
+def _predict_worker(args):
+    src_ids, beam_size, max_predict_len = args
+    if beam_size > 1:
+        return _worker_runtime.predict_beam(src_ids, beam_size, max_predict_len)
+    return _worker_runtime.predict_greedy(src_ids, max_predict_len)
+
+
+def translate_parallel(fname, id_lists, num_workers, beam_size=1,
+                       max_predict_len=20, chunksize=16):
+    '''
+    Translate id_lists with num_workers processes that all mmap the exported
+    model fname read-only. Returns the predictions in input order.
+    '''
+    with multiprocessing.Pool(num_workers, initializer=_init_worker,
+                              initargs=(fname,)) as pool:
+        return pool.map(_predict_worker,
+                        [(src_ids, beam_size, max_predict_len) for src_ids in id_lists],
+                        chunksize=chunksize)
@@ -0,0 +1,127 @@
+# coding: utf-8
+
+# ## Vocabulary shortlists for decoding
+#
+# A lexical table built from source/target co-occurrence counts in the
+# training buckets gives, for every source id, the target ids it most often
+# appears with. The candidate vocabulary of a sentence (or batch) is the
+# union of those lists, the most frequent target words and the special
+# symbols; decoding then only scores these rows of the output layer.
+# This needs word level vocabularies: character ids co-occur with nearly
+# every target, so a table over them only yields the most frequent targets.
+
+# In[ ]:
+
+import json
+import pickle
+import hashlib
+import numpy as np
+
+from nmt_config import START_VOCAB
+
+
+# In[ ]:
+
+def count_cooccurrences(pairs, vsize_tgt, chunk_size=1000000):
+    '''
+    pairs: iterable of (src_ids, tgt_ids). Every distinct (src, tgt) id pair
+    in a sentence pair is counted once. Returns (src, tgt, count) arrays and
+    the target token frequencies.
+    '''
+    keys = np.empty(0, dtype=np.int64)
+    counts = np.empty(0, dtype=np.int64)
+    tgt_freq = np.zeros(vsize_tgt, dtype=np.int64)
+    pending, num_pending = [], 0
+
+    def merge(keys, counts, pending):
+        new_keys = np.concatenate([keys] + pending)
+        new_counts = np.concatenate([counts] + [np.ones(len(p), dtype=np.int64) for p in pending])
+        uniq, inverse = np.unique(new_keys, return_inverse=True)
+        return uniq, np.bincount(inverse, weights=new_counts).astype(np.int64)
+
+    for src_ids, tgt_ids in pairs:
+        tgt_freq += np.bincount(tgt_ids, minlength=vsize_tgt)[:vsize_tgt]
+        src_u = np.unique(np.asarray(src_ids, dtype=np.int64))
+        tgt_u = np.unique(np.asarray(tgt_ids, dtype=np.int64))
+        pending.append((src_u[:, None] * vsize_tgt + tgt_u[None, :]).ravel())
+        num_pending += len(pending[-1])
+        if num_pending >= chunk_size:
+            keys, counts = merge(keys, counts, pending)
+            pending, num_pending = [], 0
+    if pending:
+        keys, counts = merge(keys, counts, pending)
+    return keys // vsize_tgt, keys % vsize_tgt, counts, tgt_freq
+
+
+def build_lex_table(pairs, vsize_src, vsize_tgt, top_k=100):
+    '''
+    For every source id keep the top_k co-occurring target ids, most
+    frequent first, in CSR form: the list of source id s is
+    indices[indptr[s]:indptr[s+1]].
+    '''
+    src, tgt, counts, tgt_freq = count_cooccurrences(pairs, vsize_tgt)
+    order = np.lexsort((-counts, src))
+    src, tgt = src[order], tgt[order]
+    rank = np.arange(len(src)) - np.searchsorted(src, src, side="left")
+    keep = rank < top_k
+    src, tgt = src[keep], tgt[keep]
+    indptr = np.zeros(vsize_src + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(src, minlength=vsize_src)[:vsize_src])
+    return {"indptr": indptr, "indices": tgt.astype(np.int32),
+            "tgt_freq": tgt_freq, "top_k": np.asarray(top_k)}
+
+
+def build_lex_table_from_buckets(bucket_fnames, vsize_src, vsize_tgt, top_k=100):
+    def pairs():
+        for fname in bucket_fnames:
+            for src_ids, tgt_ids in pickle.load(open(fname, "rb")):
+                yield src_ids, tgt_ids
+    return build_lex_table(pairs(), vsize_src, vsize_tgt, top_k)
+
+
+def lex_table_source(manifest):
+    # the text, vocabulary, settings and line ranges the buckets come from
+    return hashlib.sha1(json.dumps([manifest["key"], manifest.get("ranges")],
+                                   sort_keys=True).encode()).hexdigest()
+
+
+def lex_table_current(table, source, top_k):
+    # a stored table can be reused if built from the same buckets, with
+    # at least top_k target ids per source id
+    return ("source" in table and str(table["source"]) == source
+            and int(table["top_k"]) >= top_k)
+
+
+def save_lex_table(fname, table):
+    with open(fname, "wb") as out_f:
+        np.savez(out_f, **table)
+
+
+def load_lex_table(fname):
+    with np.load(fname) as npz:
+        return {k: npz[k] for k in npz.files}
+
+
+# In[ ]:
+
+class Shortlister(object):
+    '''
+    Candidate target ids for a set of source sentences.
+        top_k:        per source id, at most the table's top_k
+        num_frequent: most frequent target ids always included
+    '''
+    def __init__(self, table, top_k=None, num_frequent=1000):
+        self.indptr = table["indptr"]
+        self.indices = table["indices"]
+        self.top_k = int(table["top_k"]) if top_k is None else top_k
+        frequent = np.argsort(-table["tgt_freq"], kind="stable")[:num_frequent]
+        self.always = np.union1d(frequent, np.arange(len(START_VOCAB))).astype(np.int32)
+
+    def __call__(self, src_id_lists):
+        lists = [self.always]
+        for src_ids in src_id_lists:
+            for s in set(src_ids):
+                if s < len(self.indptr) - 1:
+                    start = self.indptr[s]
+                    lists.append(self.indices[start:min(start + self.top_k, self.indptr[s+1])])
+        return np.unique(np.concatenate(lists)).astype(np.int32)
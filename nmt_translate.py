@@ -22,6 +22,7 @@ import csv
 import time
 import matplotlib.gridspec as gridspec
 import importlib
+from contextlib import nullcontext
 # %matplotlib inline
 
 
@@ -46,6 +47,20 @@ _START_VOCAB = [_PAD, _GO, _EOS, _UNK]
 # In[ ]:
 
 from enc_dec_batch import *
+from nmt_data import ParallelCorpus, LineToIds, batch_pad_lims
+from nmt_data import bucket_key, load_manifest, manifest_complete, create_bucket_shards
+from nmt_data import bucket_files, load_bucket, load_appended_ranges
+from nmt_checkpoint import AsyncCheckpointer, optimizer_fname, prune_epoch_models, load_npz_grow
+from nmt_checkpoint import checkpoint_pair_matches
+from nmt_checkpoint import resume_fname, save_resume, load_resume, remove_resume
+from nmt_profile import PhaseProfiler
+from nmt_quantize import export_quantized, load_quantized, quantized_predict
+from nmt_quantize import QuantizedDecoder, float_arrays, decoder_nbytes
+from nmt_shortlist import build_lex_table_from_buckets, save_lex_table, load_lex_table, Shortlister
+from nmt_shortlist import lex_table_source, lex_table_current
+from nmt_infer import translate_batched, TranslationCache, model_fingerprint, cached_predict
+from nmt_runtime import export_model, load_runtime, translate_parallel
+from nmt_align import AlignmentWriter
 
 
 # ### All experiments in this assignment can be trained on CPUs
@@ -64,6 +79,8 @@ i2w = pickle.load(open(i2w_path, "rb"))
 vocab = pickle.load(open(vocab_path, "rb"))
 vocab_size_en = min(len(i2w["en"]), max_vocab_size["en"])
 vocab_size_fr = min(len(i2w["fr"]), max_vocab_size["fr"])
+# raw line -> ids, a byte lookup table in character mode
+line_to_ids = {lang: LineToIds(w2i[lang], CONVOLUTIONAL, UNK_ID) for lang in ("fr", "en")}
 print("vocab size, en={0:d}, fr={1:d}".format(vocab_size_en, vocab_size_fr))
 # ### Setup Model
 
@@ -72,7 +89,9 @@ print("vocab size, en={0:d}, fr={1:d}".format(vocab_size_en, vocab_size_fr))
 # Set up model
 model = EncoderDecoder(vocab_size_fr, vocab_size_en,
                        num_layers_enc, num_layers_dec, num_layers_highway,
-                       hidden_units, gpuid, segment_size, num_filters_conv, attn=use_attn, convolutional=CONVOLUTIONAL)
+                       hidden_units, gpuid, segment_size, num_filters_conv, attn=use_attn, convolutional=CONVOLUTIONAL,
+                       recompute_chunk=recompute_chunk, attn_score=attn_score,
+                       sampling_ratio=sampling_ratio)
 if gpuid >= 0:
     cuda.get_device(gpuid).use()
     model.to_gpu()
@@ -82,6 +101,10 @@ optimizer.setup(model)
 # gradient clipping
 optimizer.add_hook(chainer.optimizer.GradientClipping(threshold=5))
 
+# memoized dev/prediction translations, keyed by source ids and the weights
+translation_cache = (TranslationCache(translation_cache_mb * 2**20)
+                     if translation_cache_mb > 0 else None)
+
 
 # In[ ]:
 
@@ -90,38 +113,49 @@ print(model_fil)
 
 
 # In[ ]:
+def training_ranges():
+    # the first NUM_TRAINING_SENTENCES lines, then appended training data
+    return [[0, NUM_TRAINING_SENTENCES]] + load_appended_ranges(appended_ranges_fname)
+
+
 def create_buckets():
-    buck_width = BUCKET_WIDTH
-    buckets = [[] for i in range(NUM_BUCKETS)]
-    print("Splitting data into {0:d} buckets, each of width={1:d}".format(NUM_BUCKETS, buck_width))
-    with open(text_fname["fr"], "rb") as fr_file, open(text_fname["en"], "rb") as en_file:
-        for i, (line_fr, line_en) in enumerate(zip(fr_file, en_file), start=1):
-            if i > NUM_TRAINING_SENTENCES:
-                break
-            if CONVOLUTIONAL:
-                fr_sent = list(line_fr)
-                en_sent = list(line_en)
-            else:
-                fr_sent = line_fr.strip().split()
-                en_sent = line_en.strip().split()
-
-            if len(fr_sent) > 0 and len(en_sent) > 0:
-                max_len = min(max(len(fr_sent), len(en_sent)),
-                              BUCKET_WIDTH * NUM_BUCKETS)
-                buck_indx = ((max_len-1) // buck_width)
-
-                fr_ids = [w2i["fr"].get(w, UNK_ID) for w in fr_sent[:max_len]]
-                en_ids = [w2i["en"].get(w, UNK_ID) for w in en_sent[:max_len]]
-
-                buckets[buck_indx].append((fr_ids, en_ids))
-
-    # Saving bucket data
-    print("Saving bucket data")
-    for i, bucket in enumerate(buckets):
-        print("Bucket {0:d}, # items={1:d}".format((i+1)*BUCKET_WIDTH, len(bucket)))
-        pickle.dump(bucket, open(bucket_data_fname.format(i+1), "wb"))
-
-    #return buckets
+    '''
+    Bucket the training pairs in parallel shards (see nmt_data), unless the
+    manifest shows buckets built from the same text, vocabulary and settings.
+    Line ranges appended since the buckets were built are bucketed into new
+    shards; the existing ones are kept.
+    '''
+    bucket_params = (BUCKET_WIDTH, NUM_BUCKETS, TGT_BUCKET_WIDTH, NUM_TGT_BUCKETS)
+    params = {"num_training": NUM_TRAINING_SENTENCES, "buckets": list(bucket_params),
+              "char": CONVOLUTIONAL}
+    key = bucket_key(text_fname, w2i_path, params)
+    ranges = training_ranges()
+    manifest = load_manifest(bucket_manifest_fname)
+    if manifest and manifest_complete(manifest):
+        if manifest["key"] == key:
+            print("buckets are up to date: {0:s}".format(bucket_manifest_fname))
+            return manifest
+        done = manifest.get("ranges")
+        if (done and manifest["key"]["params"] == params and ranges[:len(done)] == done
+                and len(ranges) > len(done)):
+            # ids of existing words are stable when appending, old shards stay valid
+            print("bucketing {0:d} appended line ranges".format(len(ranges) - len(done)))
+            return create_bucket_shards(text_fname, ranges[len(done):], w2i, CONVOLUTIONAL, UNK_ID,
+                                        bucket_params, bucket_data_fname, bucket_manifest_fname,
+                                        key, workers=bucket_workers or os.cpu_count(), append=True)
+
+    print("Splitting data into {0:d}x{1:d} buckets, source width={2:d}, target width={3:d}".format(
+          NUM_BUCKETS, NUM_TGT_BUCKETS, BUCKET_WIDTH, TGT_BUCKET_WIDTH))
+    manifest = create_bucket_shards(text_fname, ranges, w2i, CONVOLUTIONAL, UNK_ID,
+                                    bucket_params, bucket_data_fname, bucket_manifest_fname, key,
+                                    workers=bucket_workers or os.cpu_count())
+
+    for i, shards in enumerate(manifest["buckets"]):
+        print("Bucket src<={0:d}, tgt<={1:d}, # items={2:d}".format(
+              (i // NUM_TGT_BUCKETS + 1) * BUCKET_WIDTH,
+              (i % NUM_TGT_BUCKETS + 1) * TGT_BUCKET_WIDTH,
+              sum(shard["count"] for shard in shards)))
+    return manifest
 
 
 # In[ ]:
@@ -142,37 +176,29 @@ def compute_prec_recall():
 def compute_dev_pplx():
     loss = 0
     num_words = 0
-    with open(text_fname["fr"], "rb") as fr_file, open(text_fname["en"], "rb") as en_file:
+    with ParallelCorpus(text_fname) as corpus:
         with tqdm(total=NUM_DEV_SENTENCES) as pbar:
             sys.stderr.flush()
             out_str = "loss={0:.6f}".format(0)
             pbar.set_description(out_str)
-            for i, (line_fr, line_en) in enumerate(zip(fr_file, en_file), start=1):
-                if i > NUM_TRAINING_SENTENCES and i <= (NUM_TRAINING_SENTENCES + NUM_DEV_SENTENCES):
-
-                    if CONVOLUTIONAL:
-                        fr_sent = list(line_fr)
-                        en_sent = list(line_en)
-                    else:
-                        fr_sent = line_fr.strip().split()
-                        en_sent = line_en.strip().split()
+            # dev lines follow the training lines
+            for line_fr, line_en in corpus.read(NUM_TRAINING_SENTENCES, NUM_DEV_SENTENCES):
 
+                fr_ids = line_to_ids["fr"](line_fr)
+                en_ids = line_to_ids["en"](line_en)
 
-                    fr_ids = [w2i["fr"].get(w, UNK_ID) for w in fr_sent]
-                    en_ids = [w2i["en"].get(w, UNK_ID) for w in en_sent]
+                # compute loss
+                curr_loss = float(model.encode_decode_train(fr_ids, en_ids, train=False).data)
+                loss += curr_loss
+                num_words += len(en_ids)
 
-                    # compute loss
-                    curr_loss = float(model.encode_decode_train(fr_ids, en_ids, train=False).data)
-                    loss += curr_loss
-                    num_words += len(en_ids)
-
-                    out_str = "loss={0:.6f}".format(curr_loss)
-                    pbar.set_description(out_str)
-                    pbar.update(1)
+                out_str = "loss={0:.6f}".format(curr_loss)
+                pbar.set_description(out_str)
+                pbar.update(1)
 
             # end of for
         # end of pbar
-    # end of with open file
+    # end of with corpus
     loss_per_word = loss / num_words
     pplx = 2 ** loss_per_word
     random_pplx = vocab_size_en
@@ -209,38 +235,54 @@ def bleu(stats):
     log_bleu_prec = sum([math.log(float(x)/y) for x,y in zip(stats[2::2],stats[3::2])]) / 4.
     return math.exp(min([0, 1-float(r)/c]) + log_bleu_prec)
 
-def compute_dev_bleu():
+def compute_dev_bleu(predict_fn=None, batch_size=None):
+    '''
+    predict_fn: maps a list of source ids to a list of predicted ids.
+                By default the dev set is decoded in length-sorted batches
+                of batch_size (infer_batch_size), or one sentence at a time
+                with model.encode_decode_predict if the batch size is 1.
+                Only the default predictions go through translation_cache
+    '''
+    if batch_size is None:
+        batch_size = infer_batch_size
     list_of_references = []
-    list_of_hypotheses = []
-    with open(text_fname["fr"], "rb") as fr_file, open(text_fname["en"], "rb") as en_file:
-        with tqdm(total=NUM_DEV_SENTENCES) as pbar:
-            sys.stderr.flush()
-            for i, (line_fr, line_en) in enumerate(zip(fr_file, en_file), start=1):
-                if i > NUM_TRAINING_SENTENCES and i <= (NUM_TRAINING_SENTENCES + NUM_DEV_SENTENCES):
-
-                    out_str = "predicting sentence={0:d}".format(i)
-                    pbar.update(1)
-
-                    if CONVOLUTIONAL:
-                        fr_sent = list(line_fr)
-                        en_sent = list(line_en)
-                    else:
-                        fr_sent = line_fr.strip().split()
-                        en_sent = line_en.strip().split()
-
-                    fr_ids = [w2i["fr"].get(w, UNK_ID) for w in fr_sent]
-                    en_ids = [w2i["en"].get(w, UNK_ID) for w in en_sent]
-
-                    # list_of_references.append(line_en.strip().split().decode())
-                    reference_words = [w.decode() for w in line_en.strip().split()]
-                    list_of_references.append(reference_words)
-                    pred_sent, alpha_arr = model.encode_decode_predict(fr_ids)
-                    pred_words = [i2w["en"][w].decode() for w in pred_sent if w != EOS_ID]
-                    # pred_sent_line = " ".join(pred_words)
-                    # list_of_hypotheses.append(pred_sent_line)
-                    list_of_hypotheses.append(pred_words)
-                if i > (NUM_TRAINING_SENTENCES + NUM_DEV_SENTENCES):
-                    break
+    with ParallelCorpus(text_fname) as corpus:
+        dev_lines = corpus.read(NUM_TRAINING_SENTENCES, NUM_DEV_SENTENCES)
+        dev_fr_ids = line_to_ids["fr"].lines([line_fr for line_fr, _ in dev_lines])
+        for line_fr, line_en in dev_lines:
+            # list_of_references.append(line_en.strip().split().decode())
+            reference_words = [w.decode() for w in line_en.strip().split()]
+            list_of_references.append(reference_words)
+
+    batch_stats = None
+    cache = translation_cache if predict_fn is None else None
+    fingerprint = model_fingerprint(model) if cache else None
+    with tqdm(total=len(dev_fr_ids)) as pbar:
+        sys.stderr.flush()
+        if predict_fn is None and batch_size > 1:
+            pred_sents, batch_stats = translate_batched(model, dev_fr_ids, batch_size,
+                                                        BUCKET_WIDTH, MAX_PREDICT_LEN,
+                                                        progress=pbar.update,
+                                                        cache=cache, fingerprint=fingerprint)
+        else:
+            if predict_fn is None:
+                predict_fn = lambda fr_ids: model.encode_decode_predict(fr_ids, MAX_PREDICT_LEN)[0]
+                if cache:
+                    predict_fn = cached_predict(predict_fn, cache, fingerprint, MAX_PREDICT_LEN)
+            pred_sents = []
+            for fr_ids in dev_fr_ids:
+                pred_sents.append(predict_fn(fr_ids))
+                pbar.update(1)
+
+    list_of_hypotheses = [[i2w["en"][w].decode() for w in pred_sent if w != EOS_ID]
+                          for pred_sent in pred_sents]
+    if batch_stats:
+        print("{0:d} batches, padding efficiency={1:0.4f}, {2:d} repeated sources".format(
+              batch_stats["batches"], batch_stats["padding_efficiency"], batch_stats["duplicates"]))
+    if cache:
+        cache_stats = cache.stats()
+        print("translation cache: hit rate={0:0.4f}, {1:d} entries, {2:.1f} MiB".format(
+              cache_stats["hit_rate"], cache_stats["entries"], cache_stats["bytes"] / 2.**20))
 
     stats = [0 for i in range(10)]
     for (r,h) in zip(list_of_references, list_of_hypotheses):
@@ -251,6 +293,182 @@ def compute_dev_bleu():
 
 
 
+def compare_inference_dtype(dtype):
+    '''
+    Dev BLEU of the float32 model, then of the same model with embeddings and
+    output layer stored as dtype ("float16" or "int8"). The model stays
+    compressed afterwards.
+    '''
+    print("float32 model: {0:.1f} MiB".format(model.nbytes() / 2.**20))
+    bleu_fp32 = compute_dev_bleu()
+    model.compress_for_inference(dtype)
+    print("{0:s} model: {1:.1f} MiB".format(dtype, model.nbytes() / 2.**20))
+    bleu_compressed = compute_dev_bleu()
+    print("{0:s}".format("-"*50))
+    print("{0:s} | {1:0.2f}".format("BLEU float32", bleu_fp32))
+    print("{0:s} | {1:0.2f}".format("BLEU " + dtype, bleu_compressed))
+    print("{0:s} | {1:+0.2f}".format("BLEU delta", bleu_compressed - bleu_fp32))
+    print("{0:s}".format("-"*50))
+    return bleu_fp32, bleu_compressed
+
+
+def compare_quantized():
+    '''
+    Export the int8 decoder, calibrated on the first dev sentences, and
+    compare its dev BLEU and decoding time with the float32 weights run by
+    the same numpy decoder.
+    '''
+    with ParallelCorpus(text_fname) as corpus:
+        calib_id_lists = line_to_ids["fr"].lines(
+            [line_fr for line_fr, _ in corpus.read(NUM_TRAINING_SENTENCES, quant_calib_sentences)])
+    export_quantized(model, calib_id_lists, quantized_model_fil, MAX_PREDICT_LEN)
+    qdec = load_quantized(quantized_model_fil)
+
+    fdec = QuantizedDecoder(float_arrays(model))
+
+    start = time.time()
+    bleu_fp32 = compute_dev_bleu(lambda fr_ids: quantized_predict(model, fdec, fr_ids, MAX_PREDICT_LEN))
+    time_fp32 = time.time() - start
+    start = time.time()
+    bleu_int8 = compute_dev_bleu(lambda fr_ids: quantized_predict(model, qdec, fr_ids, MAX_PREDICT_LEN))
+    time_int8 = time.time() - start
+
+    mib_fp32 = decoder_nbytes(fdec.arrays) / 2.**20
+    mib_int8 = decoder_nbytes(qdec.arrays) / 2.**20
+    print("{0:s}".format("-"*50))
+    print("{0:s} | {1:>6s} | {2:>8s} | {3:>9s}".format("decoder", "BLEU", "time", "memory"))
+    print("{0:s} | {1:6.2f} | {2:7.2f}s | {3:6.1f}MiB".format("float32", bleu_fp32, time_fp32, mib_fp32))
+    print("{0:s} | {1:6.2f} | {2:7.2f}s | {3:6.1f}MiB".format("int8   ", bleu_int8, time_int8, mib_int8))
+    print("{0:s} | {1:+6.2f} | x{2:7.2f} | x{3:7.2f}".format("change ", bleu_int8 - bleu_fp32,
+          time_int8 / time_fp32 if time_fp32 else 0., mib_int8 / mib_fp32 if mib_fp32 else 0.))
+    print("{0:s}".format("-"*50))
+    return bleu_fp32, bleu_int8
+
+def compare_shortlist():
+    '''
+    Dev BLEU, decoding time, shortlist size and reference coverage when
+    decoding over per-sentence candidate vocabularies, for each value in
+    shortlist_top_k, against the full vocabulary.
+    Needs word level vocabularies: with CONVOLUTIONAL both sides are
+    characters, each source character co-occurs with nearly every target
+    and the target vocabulary is already small, so nothing is reported.
+    '''
+    if CONVOLUTIONAL:
+        print("shortlists need word level vocabularies: with CONVOLUTIONAL the "
+              "lexical table is keyed by source characters, which co-occur with "
+              "nearly every target, so it would only give the most frequent "
+              "targets; skipping the shortlist report")
+        return None
+    manifest = load_manifest(bucket_manifest_fname)
+    source = lex_table_source(manifest)
+    table = load_lex_table(lex_table_fname) if os.path.exists(lex_table_fname) else None
+    if table is None or not lex_table_current(table, source, max(shortlist_top_k)):
+        print("building lexical table from the training buckets")
+        table = build_lex_table_from_buckets(
+                    [fname for i in range(NUM_BUCKET_FILES) for fname in bucket_files(manifest, i)],
+                    vocab_size_fr, vocab_size_en, top_k=max(shortlist_top_k))
+        table["source"] = np.asarray(source)
+        save_lex_table(lex_table_fname, table)
+
+    with ParallelCorpus(text_fname) as corpus:
+        dev_lines = corpus.read(NUM_TRAINING_SENTENCES, NUM_DEV_SENTENCES)
+    dev_ids = list(zip(line_to_ids["fr"].lines([line_fr for line_fr, _ in dev_lines]),
+                       line_to_ids["en"].lines([line_en for _, line_en in dev_lines])))
+
+    start = time.time()
+    # own predict_fn, so that the timing does not use translation_cache
+    bleu_full = compute_dev_bleu(lambda fr_ids: model.encode_decode_predict(fr_ids, MAX_PREDICT_LEN)[0])
+    time_full = time.time() - start
+    rows = [("full", vocab_size_en, 1., bleu_full, time_full)]
+
+    for top_k in shortlist_top_k:
+        shortlister = Shortlister(table, top_k=top_k, num_frequent=shortlist_num_frequent)
+        sizes, covered, total = [], 0, 0
+        for fr_ids, en_ids in dev_ids:
+            candidates = set(shortlister([fr_ids]).tolist())
+            sizes.append(len(candidates))
+            covered += sum(1 for w in en_ids if w in candidates)
+            total += len(en_ids)
+        start = time.time()
+        bleu_k = compute_dev_bleu(lambda fr_ids: model.encode_decode_predict(
+                                      fr_ids, MAX_PREDICT_LEN, shortlister([fr_ids]))[0])
+        rows.append(("top {0:d}".format(top_k), np.mean(sizes),
+                     covered / max(total, 1), bleu_k, time.time() - start))
+
+    print("{0:s}".format("-"*50))
+    print("{0:10s} | {1:>8s} | {2:>8s} | {3:>6s} | {4:>8s}".format(
+          "shortlist", "size", "coverage", "BLEU", "time"))
+    for name, size, coverage, bleu_score, secs in rows:
+        print("{0:10s} | {1:8.1f} | {2:8.4f} | {3:6.2f} | {4:7.2f}s".format(
+              name, size, coverage, bleu_score, secs))
+    print("{0:s}".format("-"*50))
+    return rows
+
+
+def check_runtime():
+    '''
+    Export the model for the numpy runtime, reload it and compare its
+    greedy predictions and decoding time with the chainer model on the dev
+    sentences.
+    '''
+    export_model(model, runtime_model_fil)
+    runtime = load_runtime(runtime_model_fil, mmap=True)
+
+    with ParallelCorpus(text_fname) as corpus:
+        dev_ids = line_to_ids["fr"].lines(
+            [line_fr for line_fr, _ in corpus.read(NUM_TRAINING_SENTENCES, NUM_DEV_SENTENCES)])
+
+    start = time.time()
+    chainer_preds = [model.encode_decode_predict(fr_ids, MAX_PREDICT_LEN)[0] for fr_ids in dev_ids]
+    time_chainer = time.time() - start
+    start = time.time()
+    runtime_preds = [runtime.predict_greedy(fr_ids, MAX_PREDICT_LEN) for fr_ids in dev_ids]
+    time_runtime = time.time() - start
+
+    max_diff = 0.
+    for fr_ids in dev_ids[:10]:
+        model.reset_state()
+        model.encode_list(fr_ids, train=False)
+        enc_states, _ = runtime.encode(fr_ids)
+        max_diff = max(max_diff, float(np.abs(cuda.to_cpu(model.enc_states.data) - enc_states).max()))
+    matches = sum(1 for p, q in zip(chainer_preds, runtime_preds) if p == q)
+
+    if translate_workers > 0:
+        start = time.time()
+        parallel_preds = translate_parallel(runtime_model_fil, dev_ids, translate_workers,
+                                            max_predict_len=MAX_PREDICT_LEN)
+        time_parallel = time.time() - start
+
+    print("{0:s}".format("-"*50))
+    print("{0:s} | {1:d}/{2:d}".format("identical predictions", matches, len(dev_ids)))
+    print("{0:s} | {1:.2e}".format("max encoder state diff", max_diff))
+    print("{0:s} | {1:0.2f}s".format("chainer", time_chainer))
+    print("{0:s} | {1:0.2f}s".format("numpy runtime", time_runtime))
+    if translate_workers > 0:
+        print("{0:s} | {1:0.2f}s | {2:s}".format(
+              "{0:d} mmap workers".format(translate_workers), time_parallel,
+              "identical" if parallel_preds == runtime_preds else "DIFFERENT"))
+    print("{0:s}".format("-"*50))
+    return matches, max_diff
+
+
+def write_dev_alignments(fname=None, top_k=None):
+    '''
+    Decode the dev set one sentence at a time and write the sparse top_k
+    attention alignments of every prediction to fname.
+    '''
+    fname = fname or align_fname
+    writer = AlignmentWriter(top_k or align_top_k)
+    with ParallelCorpus(text_fname) as corpus:
+        dev_ids = line_to_ids["fr"].lines(
+            [line_fr for line_fr, _ in corpus.read(NUM_TRAINING_SENTENCES, NUM_DEV_SENTENCES)])
+    for fr_ids in tqdm(dev_ids):
+        pred_ids, alpha_arr = model.encode_decode_predict(fr_ids, MAX_PREDICT_LEN, record_attn=True)
+        writer.add(fr_ids, pred_ids, cuda.to_cpu(alpha_arr))
+    writer.save(fname)
+    return writer
+
+
 # ### Training loop
 
 # In[ ]:
@@ -280,15 +498,8 @@ def train_loop(text_fname, num_training, num_epochs, log_mode="a"):
 
                 for i, (line_fr, line_en) in enumerate(zip(fr_file, en_file), start=1):
 
-                    if CONVOLUTIONAL:
-                        fr_sent = list(line_fr)
-                        en_sent = list(line_en)
-                    else:
-                        fr_sent = line_fr.strip().split()
-                        en_sent = line_en.strip().split()
-
-                    fr_ids = [w2i["fr"].get(w, UNK_ID) for w in fr_sent]
-                    en_ids = [w2i["en"].get(w, UNK_ID) for w in en_sent]
+                    fr_ids = line_to_ids["fr"](line_fr)
+                    en_ids = line_to_ids["en"](line_en)
 
                     it = (epoch * NUM_TRAINING_SENTENCES) + i
 
@@ -378,10 +589,25 @@ def train_loop(text_fname, num_training, num_epochs, log_mode="a"):
 
 
 # In[ ]:
-def batch_train_loop(bucket_fname, num_epochs,
-                     batch_size=10, num_buckets=NUM_BUCKETS,
-                     num_training=2,
-                     bucket_width=BUCKET_WIDTH, log_mode="a", last_epoch_id=0):
+def scale_grads(link, scale):
+    for param in link.params():
+        if param.grad is not None:
+            param.grad *= scale
+
+
+def batch_train_loop(manifest_fname, num_epochs,
+                     batch_size=10, num_buckets=NUM_BUCKET_FILES,
+                     num_training=2, log_mode="a", last_epoch_id=0,
+                     resume=None, first_range=0):
+    '''
+    manifest_fname: bucket manifest written by create_buckets
+    first_range:    train only on manifest["ranges"][first_range:]
+    Every batch is padded to its longest source and target sentence.
+    The optimizer updates after every grad_accum_steps batches, on the
+    mean loss per target token of those batches.
+    resume: position dict returned by load_resume, to continue an
+            interrupted run from its last step checkpoint
+    '''
 
     # Set up log file for loss
     log_train_fil = open(log_train_fil_name, mode=log_mode)
@@ -390,46 +616,114 @@ def batch_train_loop(bucket_fname, num_epochs,
     log_dev_fil = open(log_dev_fil_name, mode=log_mode)
     log_dev_csv = csv.writer(log_dev_fil, lineterminator="\n")
 
+    manifest = load_manifest(manifest_fname)
+
     # initialize perplexity on dev set
     # save model when new epoch value is lower than previous
     pplx = float("inf")
     bleu_score = 0
 
+    # model files are written in the background while training continues
+    checkpointer = AsyncCheckpointer(asynchronous=async_checkpoint)
+    opt_to_save = optimizer if save_optimizer_state else None
+    resume_fil = resume_fname(model_fil)
+
+    # position in the data where this run starts
+    start_epoch, start_bucket, start_offset = 0, 0, 0
+    if resume:
+        start_epoch = resume["epoch"]
+        start_bucket = resume["bucket"]
+        start_offset = resume["offset"]
+        print("resuming epoch={0:d}, bucket={1:d}, offset={2:d}".format(
+               last_epoch_id+start_epoch+1, start_bucket+1, start_offset))
+
+    # per phase timing, written next to the training log after every epoch
+    profiler = PhaseProfiler() if profile_train else None
+    model.profiler = profiler
+
+    def timed(name):
+        return profiler.phase(name) if profiler else nullcontext()
+
+    def position(epoch, buck_indx, offset, train_count, loss_per_epoch):
+        return {"run_epoch_id": last_epoch_id, "epoch": epoch, "bucket": buck_indx,
+                "offset": offset, "train_count": train_count,
+                "loss_per_epoch": loss_per_epoch}
+
+    # batches and target tokens whose gradients are summed in the params
+    accum = {"batches": 0, "tokens": 0}
+
+    def apply_update():
+        if accum["batches"] == 0:
+            return
+        # the summed token losses become the mean loss per target token
+        scale_grads(model, 1. / max(accum["tokens"], 1))
+        with timed("update"):
+            optimizer.update()
+        accum["batches"], accum["tokens"] = 0, 0
+
     sys.stderr.flush()
 
-    for epoch in range(num_epochs):
+    for epoch in range(start_epoch, num_epochs):
         train_count = 0
-        with tqdm(total=num_training) as pbar:
+        loss_per_epoch = 0
+        num_batches = 0
+        num_updates = 0
+        if resume and epoch == start_epoch:
+            train_count = resume["train_count"]
+            loss_per_epoch = resume["loss_per_epoch"]
+        with tqdm(total=num_training, initial=train_count) as pbar:
             sys.stderr.flush()
-            loss_per_epoch = 0
             out_str = "epoch={0:d}, iter={1:d}, loss={2:.4f}, mean loss={3:.4f}, bucket={4:d}".format(
                             epoch+1, 0, 0, 0,0)
             pbar.set_description(out_str)
 
             for buck_indx in range(num_buckets):
-                bucket_data = pickle.load(open(bucket_data_fname.format(buck_indx+1), "rb"))
-                buck_pad_lim = (buck_indx+1) * bucket_width
-
-                for i in range(0, len(bucket_data), batch_size):
+                if epoch == start_epoch and buck_indx < start_bucket:
+                    continue
+                if profiler:
+                    profiler.set_context(last_epoch_id+epoch+1, buck_indx+1)
+                with timed("load"):
+                    bucket_data = load_bucket(manifest, buck_indx, first_range)
+
+                first_offset = 0
+                if epoch == start_epoch and buck_indx == start_bucket:
+                    first_offset = start_offset
+
+                for i in range(first_offset, len(bucket_data), batch_size):
                     if train_count >= num_training:
                         break
                     next_batch_end = min(batch_size, (num_training-train_count))
                     #print("current batch")
                     #print(bucket_data[i:i+next_batch_end])
                     #print("bucket limit", buck_pad_lim)
-                    curr_len = len(bucket_data[i:i+next_batch_end])
+                    curr_batch = bucket_data[i:i+next_batch_end]
+                    curr_len = len(curr_batch)
+                    src_lim, tar_lim = batch_pad_lims(curr_batch,
+                                                      segment_size if CONVOLUTIONAL else 1)
 
-                    loss = model.encode_decode_train_batch(bucket_data[i:i+next_batch_end],
-                                                          buck_pad_lim, buck_pad_lim)
+                    loss = model.encode_decode_train_batch(curr_batch, src_lim, tar_lim)
                     train_count += curr_len
 
                     # set up for backprop
-                    model.cleargrads()
-                    loss.backward()
+                    with timed("backward"):
+                        if accum["batches"] == 0:
+                            model.cleargrads()
+                        # the loss is a per-step batch mean, make it a token sum
+                        (loss * curr_len).backward()
+                    # target tokens including EOS
+                    num_tokens = sum(len(tar) + 1 for _, tar in curr_batch)
+                    accum["batches"] += 1
+                    accum["tokens"] += num_tokens
                     # update parameters
-                    optimizer.update()
-                    # store loss value for display
-                    loss_val = float(loss.data)
+                    updated = accum["batches"] >= grad_accum_steps
+                    if updated:
+                        apply_update()
+                        num_updates += 1
+                    if profiler:
+                        profiler.add_batch(curr_len, sum(len(src) for src, _ in curr_batch),
+                                           sum(len(tar) for _, tar in curr_batch))
+                    # store loss per target token for display
+                    loss_val = float(loss.data) * curr_len / max(num_tokens, 1)
                     loss_per_epoch += loss_val
 
                     it = (epoch * NUM_TRAINING_SENTENCES) + curr_len
@@ -443,21 +737,43 @@ def batch_train_loop(bucket_fname, num_epochs,
                     if i % 10 == 0:
                         log_train_csv.writerow([it, loss_val])
 
+                    # step checkpoint, pointing at the next batch, only
+                    # between updates so that no gradients are pending
+                    num_batches += 1
+                    if (updated and checkpoint_every_batches > 0
+                            and num_updates % checkpoint_every_batches == 0):
+                        save_resume(checkpointer, resume_fil, model, optimizer,
+                                    position(epoch, buck_indx, i+batch_size,
+                                             train_count, loss_per_epoch))
+
                 if train_count >= num_training:
                     break
 
+            # update with the batches left over at the end of the epoch
+            apply_update()
+
         print("finished training on {0:d} sentences".format(num_training))
+        if profiler:
+            profiler.print_summary(last_epoch_id+epoch+1)
+            profiler.write_csv(log_profile_fil_name + ".csv")
+            profiler.write_json(log_profile_fil_name + ".json")
         print("{0:s}".format("-"*50))
         print("computing perplexity")
         pplx_new = compute_dev_pplx()
         print("Saving model")
-        serializers.save_npz(model_fil.replace(".model", "_{0:d}.model".format(last_epoch_id+epoch+1)), model)
-        print("Finished saving model")
+        epoch_model_fil = model_fil.replace(".model", "_{0:d}.model".format(last_epoch_id+epoch+1))
+        checkpointer.save(epoch_model_fil, model, opt_to_save)
+        checkpointer.submit(lambda: prune_epoch_models(model_fil, keep_epoch_models))
+        if checkpoint_every_batches > 0:
+            # a resume from here starts with the next epoch
+            save_resume(checkpointer, resume_fil, model, optimizer,
+                        position(epoch+1, 0, 0, 0, 0))
+        print("Queued model for saving")
         pplx = pplx_new
         print("wooohooo!")
         print(log_train_fil_name)
         print(log_dev_fil_name)
-        print(model_fil.replace(".model", "_{0:d}.model".format(epoch+1)))
+        print(epoch_model_fil)
 
         if epoch % 2 == 0:
             bleu_score = compute_dev_bleu()
@@ -476,8 +792,13 @@ def batch_train_loop(bucket_fname, num_epochs,
     compute_dev_bleu()
     print("{0:s}".format("-"*50))
 
+    model.profiler = None
+
     print("Final saving model")
-    serializers.save_npz(model_fil, model)
+    checkpointer.save(model_fil, model, opt_to_save)
+    # training finished, nothing left to resume
+    checkpointer.submit(lambda: remove_resume(resume_fil))
+    checkpointer.close()
     print("Finished saving model")
 
     # close log file
@@ -560,22 +881,24 @@ def plot_attention(alpha_arr, fr, en, plot_name=None):
 
 # In[ ]:
 
-def predict_sentence(line_num, line_fr, line_en=None, display=True, plot_name=None, p_filt=0, r_filt=0):
+def predict_sentence(line_num, line_fr, line_en=None, display=True, plot_name=None, p_filt=0, r_filt=0,
+                     pred_ids=None):
+    # pred_ids: prediction computed beforehand (e.g. batched), no attention plot then
     if CONVOLUTIONAL:
         fr_sent = list(line_fr)
     else:
         fr_sent = line_fr.strip().split()
-    fr_ids = [w2i["fr"].get(w, UNK_ID) for w in fr_sent]
+    fr_ids = line_to_ids["fr"](line_fr)
     # english reference is optional. If provided, compute precision/recall
     if line_en:
-        if CONVOLUTIONAL:
-            en_sent = list(line_en)
-        else:
-            en_sent = line_en.strip().split()
-
-        en_ids = [w2i["en"].get(w, UNK_ID) for w in en_sent]
+        en_ids = line_to_ids["en"](line_en)
 
-    pred_ids, alpha_arr = model.encode_decode_predict(fr_ids)
+    if pred_ids is None:
+        # attention is only recorded when it is plotted
+        pred_ids, alpha_arr = model.encode_decode_predict(fr_ids, MAX_PREDICT_LEN,
+                                                          record_attn=bool(plot_name))
+    else:
+        alpha_arr, plot_name = None, None
     pred_words = [i2w["en"][w].decode() for w in pred_ids]
 
     prec = 0
@@ -622,24 +945,35 @@ def predict(s=NUM_TRAINING_SENTENCES, num=NUM_DEV_SENTENCES, display=True, plot=
 
     filter_count = 0
 
-    with open(text_fname["fr"], "rb") as fr_file, open(text_fname["en"], "rb") as en_file:
-        for i, (line_fr, line_en) in enumerate(zip(fr_file, en_file), start=0):
-            if i >= s and i < (s+num):
-                if plot:
-                    plot_name = os.path.join(model_dir, "sample_{0:d}_plot.png".format(i+1))
-                else:
-                    plot_name=None
-
-                # make prediction
-                cp, tp, t, f = predict_sentence(i, line_fr,
-                                             line_en,
-                                             display=display,
-                                             plot_name=plot_name,
-                                             p_filt=p_filt, r_filt=r_filt)
-                metrics["cp"].append(cp)
-                metrics["tp"].append(tp)
-                metrics["t"].append(t)
-                filter_count += (1 if f else 0)
+    with ParallelCorpus(text_fname) as corpus:
+        lines = corpus.read(s, num)
+
+    # attention plots need the per sentence decoder, otherwise decode in batches
+    batch_preds = [None] * len(lines)
+    if not plot and infer_batch_size > 1:
+        fr_id_lists = line_to_ids["fr"].lines([line_fr for line_fr, _ in lines])
+        fingerprint = model_fingerprint(model) if translation_cache else None
+        batch_preds, _ = translate_batched(model, fr_id_lists, infer_batch_size, BUCKET_WIDTH,
+                                           MAX_PREDICT_LEN,
+                                           cache=translation_cache, fingerprint=fingerprint)
+
+    for i, (line_fr, line_en) in enumerate(lines, start=s):
+        if plot:
+            plot_name = os.path.join(model_dir, "sample_{0:d}_plot.png".format(i+1))
+        else:
+            plot_name=None
+
+        # make prediction
+        cp, tp, t, f = predict_sentence(i, line_fr,
+                                     line_en,
+                                     display=display,
+                                     plot_name=plot_name,
+                                     p_filt=p_filt, r_filt=r_filt,
+                                     pred_ids=batch_preds[i-s])
+        metrics["cp"].append(cp)
+        metrics["tp"].append(tp)
+        metrics["t"].append(t)
+        filter_count += (1 if f else 0)
 
     print("sentences matching filter = {0:d}".format(filter_count))
     return metrics
@@ -676,9 +1010,16 @@ def main():
         print("not creating buckets as requested. will crash if buckets not present")
 
     max_epoch_id = 0
-    if os.path.exists(model_fil):
+    resume = None
+    if load_existing_model and os.path.exists(resume_fname(model_fil)):
+        # an interrupted run left a step checkpoint, continue from it
+        print("loading resume checkpoint ...")
+        resume = load_resume(resume_fname(model_fil), model, optimizer)
+        max_epoch_id = resume["run_epoch_id"]
+        print("finished loading: {0:s}".format(resume_fname(model_fil)))
+    elif os.path.exists(model_fil):
         # check last saved epoch model:
-        for fname in [f for f in os.listdir(model_dir) if f.endswith("")]:
+        for fname in [f for f in os.listdir(model_dir) if f.endswith(".model")]:
             if model_fil != os.path.join(model_dir, fname) and model_fil.replace(".model", "") in os.path.join(model_dir, fname):
                 try:
                     epoch_id = int(fname.split("_")[-1].replace(".model", ""))
@@ -690,21 +1031,43 @@ def main():
 
         if load_existing_model:
             print("loading model ...")
-            serializers.load_npz(model_fil, model)
+            # embeddings and output layer grow if the vocabulary was appended to
+            load_npz_grow(model_fil, model)
             print("finished loading: {0:s}".format(model_fil))
+            if os.path.exists(optimizer_fname(model_fil)):
+                if checkpoint_pair_matches(model_fil):
+                    # restore Adam moments so training continues where it stopped
+                    load_npz_grow(optimizer_fname(model_fil), optimizer)
+                    print("finished loading: {0:s}".format(optimizer_fname(model_fil)))
+                else:
+                    print("{0:s} was not saved with the model, not loading it".format(
+                          optimizer_fname(model_fil)))
         else:
             print("""model file already exists!!
                 Delete before continuing, or enable load_existing flag""".format(model_fil))
             return
     if NUM_EPOCHS > 0:
         #train_loop(text_fname, NUM_TRAINING_SENTENCES, NUM_EPOCHS)
-        batch_train_loop(bucket_data_fname,
+        ranges = training_ranges()
+        first_range = 1 if train_appended_only else 0
+        batch_train_loop(bucket_manifest_fname,
                  num_epochs=NUM_EPOCHS,
                  batch_size=BATCH_SIZE,
-                 num_buckets=NUM_BUCKETS,
-                 num_training=NUM_TRAINING_SENTENCES,
-                 bucket_width=BUCKET_WIDTH, last_epoch_id=max_epoch_id)
+                 num_buckets=NUM_BUCKET_FILES,
+                 num_training=sum(num for _, num in ranges[first_range:]),
+                 last_epoch_id=max_epoch_id,
+                 resume=resume, first_range=first_range)
         compute_dev_bleu()
+    elif export_alignments and use_attn:
+        write_dev_alignments()
+    elif export_runtime:
+        check_runtime()
+    elif quantize_decoder:
+        compare_quantized()
+    elif shortlist_report:
+        compare_shortlist()
+    elif inference_dtype != "float32":
+        compare_inference_dtype(inference_dtype)
 
 
 if __name__ == "__main__":
@@ -3,12 +3,24 @@
 # ## Prepare parallel corpus
 # 
 # **Based on TensorFlow code: https://github.com/tensorflow/models/blob/master/tutorials/rnn/translate/data_utils.py**
+#
+# Every stage (Morfessor model, tokenized text, vocabulary) is cached in
+# cache_dir under a key hashed from everything it depends on: the raw corpus,
+# the key of the previous stage and the relevant settings. A stage only runs
+# when its key is not cached yet, so changing model hyperparameters never
+# re-tokenizes, and switching settings back reuses the earlier results.
 
 # In[ ]:
 
 import os
 import re
+import math
+import random
+import json
 import pickle
+import shutil
+import hashlib
+import itertools
 from tqdm import tqdm
 import sys
 import morfessor
@@ -17,65 +29,160 @@ import morfessor
 # In[ ]:
 
 from nmt_config import *
+from nmt_data import file_digest, load_line_index, extend_line_index
+from nmt_data import load_appended_ranges, save_appended_ranges
 
 
 # In[ ]:
-if DATASET == 'MORFESSOR':
-    morf = morfessor.BaselineModel()
-    io = morfessor.io.MorfessorIO()
 
 data_fname = {"en": os.path.join(data_dir, "text_all.en"),
               "fr": os.path.join(data_dir, "text_all.fr")}
 
-if DATASET == 'MORFESSOR' and not os.path.exists("morfmodel"):
-    corpus = list(io.read_corpus_file(data_fname["fr"]))
-    enccorpus = []
-    morf.load_data(corpus)
-    morf.train_batch()
-    io.write_binary_model_file("morfmodel", morf)
+cache_dir = os.path.join(data_dir, "cache")
+# change when basic_tokenizer or extract_k_lines change their output
+TOKENIZER_VERSION = 1
 
-elif DATASET == 'MORFESSOR' and os.path.exists("morfmodel"):
-    morf = io.read_any_model("morfmodel")
+# Morfessor model, loaded by load_morfessor when the MORFESSOR dataset
+# needs to be tokenized
+morf = None
 
 
 # In[ ]:
 
-# Regular expressions used to tokenize.
-_WORD_SPLIT = re.compile(b"([.,!?\"':~;)(])")
-_DIGIT_RE = re.compile(br"\d")
+def stage_key(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def cache_fname(stage, key, ext):
+    return os.path.join(cache_dir, "{0:s}_{1:s}{2:s}".format(stage, key[:16], ext))
+
+
+def publish(cached_fname, fname):
+    # copy a cached file to where the rest of the code expects it
+    if (os.path.exists(fname) and os.path.getsize(fname) == os.path.getsize(cached_fname)
+            and file_digest(fname) == file_digest(cached_fname)):
+        return
+    shutil.copyfile(cached_fname, fname + ".tmp")
+    os.replace(fname + ".tmp", fname)
+
+
+def count_words(fname, max_words, subsample=1., report_every=1000000):
+    '''
+    Stream fname into a word count dict, keeping a subsample fraction of the
+    lines. Whenever there are more than max_words distinct words, the
+    minimum count is raised and rarer words are dropped, so memory stays
+    bounded on any corpus size. Returns the counts and the minimum count.
+    '''
+    rng = random.Random(0)
+    counts = {}
+    min_count = 1
+    with open(fname, "rb") as in_f:
+        for i, line in enumerate(in_f):
+            if (i + 1) % report_every == 0:
+                print("read {0:d} lines, {1:d} distinct words".format(i + 1, len(counts)))
+            if subsample < 1 and rng.random() >= subsample:
+                continue
+            for w in line.decode().split():
+                counts[w] = counts.get(w, 0) + 1
+            if len(counts) > max_words:
+                while len(counts) > max_words * 3 // 4:
+                    min_count += 1
+                    counts = {w: c for w, c in counts.items() if c >= min_count}
+    return counts, min_count
+
+
+def dampening(name):
+    # count modifiers of the morfessor command line tool
+    if name == "log":
+        return lambda x: int(round(math.log(x + 1, 2)))
+    if name == "ones":
+        return lambda x: 1
+    return None
+
+
+def online_stream(counts, count_modifier=None, report_every=10000):
+    '''
+    (1, word) tuples for train_online: every word is fed count_modifier(count)
+    times, in rounds over the word list so that repeats are spread out.
+    '''
+    reps = {w: count_modifier(c) if count_modifier else c for w, c in counts.items()}
+    fed = 0
+    rnd = 0
+    while reps:
+        for w in reps:
+            yield 1, w
+            fed += 1
+            if fed % report_every == 0:
+                print("Morfessor online: {0:d} words fed, round {1:d}".format(fed, rnd))
+        rnd += 1
+        reps = {w: n for w, n in reps.items() if n > rnd}
+
+
+def morfessor_key(fr_digest):
+    settings = [morf_online, morf_max_words, morf_subsample, morf_dampening]
+    if morf_online:
+        settings.append(morf_epoch_interval)
+    return stage_key("morfessor", fr_digest, settings)
+
+
+def load_morfessor(key):
+    global morf
+    io = morfessor.io.MorfessorIO()
+    model_fname = cache_fname("morf", key, ".bin")
+    if os.path.exists(model_fname):
+        print("loading cached Morfessor model: {0:s}".format(model_fname))
+        morf = io.read_any_model(model_fname)
+        return
+    morf = morfessor.BaselineModel()
+    counts, min_count = count_words(data_fname["fr"], morf_max_words, morf_subsample)
+    print("Morfessor word list: {0:d} words, min count {1:d}".format(len(counts), min_count))
+    count_modifier = dampening(morf_dampening)
+    if morf_online:
+        epochs, cost = morf.train_online(online_stream(counts, count_modifier, morf_epoch_interval),
+                                         epoch_interval=morf_epoch_interval)
+        print("Morfessor online training: {0:d} epochs, cost {1:.2f}".format(epochs, cost))
+    else:
+        morf.load_data(((c, w) for w, c in counts.items()), count_modifier=count_modifier)
+        morf.train_batch()
+    io.write_binary_model_file(model_fname + ".tmp", morf)
+    os.replace(model_fname + ".tmp", model_fname)
+
+
+# In[ ]:
+
+# Punctuation dropped by the tokenizer. A token is a maximal run of bytes
+# that are neither whitespace nor punctuation, which is what splitting on
+# whitespace, then on punctuation, and dropping the punctuation gives.
+_PUNCT = b".,!?\"':~;)("
+_TOKEN_RE = re.compile(b"[^\\s" + re.escape(_PUNCT) + b"]+")
 
 
 # In[ ]:
 
 def basic_tokenizer(sentence, fr=False):
     """Very basic tokenizer: split the sentence into a list of tokens."""
-    err = 0
-    tok = 0
-    words = []
-    for space_separated_fragment in sentence.strip().split():
-        words.extend(_WORD_SPLIT.sub(b"", w) for w in _WORD_SPLIT.split(space_separated_fragment))
-
     if DATASET == 'MORFESSOR' and fr:
         morphs = []
-        for word in words:
-            tok += 1
+        for word in _TOKEN_RE.findall(sentence):
             try:
                 word = morf.segment(word.decode())
             except KeyError:
-                err +=1
                 word = morf.viterbi_segment(word.decode())[0]
             morphs.extend([morph.encode() for morph in word])
         return morphs
 
     else:
-        return [w.lower() for w in words if w]
+        # lower() only changes ASCII letters, so it can run before the split
+        return _TOKEN_RE.findall(sentence.lower())
 
 
 # In[ ]:
 
-def extract_k_lines(fr_fname, en_fname, k):
+def extract_k_lines(fr_fname, en_fname, k, src_fname=data_fname):
     num_lines = 0
-    with open(data_fname["fr"],"rb") as f_fr, open(data_fname["en"],"rb") as f_en:
+    # the loop does not run for empty files
+    i = 0
+    with open(src_fname["fr"],"rb") as f_fr, open(src_fname["en"],"rb") as f_en:
         with open(fr_fname,"wb") as out_fr, open(en_fname,"wb") as out_en:
             for i, (line_fr, line_en) in enumerate(zip(f_fr, f_en)):
                 if num_lines >= k:
@@ -89,35 +196,38 @@ def extract_k_lines(fr_fname, en_fname, k):
                     num_lines += 1
         print("Total lines={0:d}, valid lines={1:d}".format(i, num_lines))
         print("finished writing {0:s} and {1:s}".format(fr_fname, en_fname))
+    return num_lines
     
 
 
 # In[ ]:
 
+def count_tokens(lines, char=False, vocab=None):
+    # add the token counts of lines to vocab
+    vocab = {} if vocab is None else vocab
+    for line in lines:
+        words = line.strip().split()
+        for w in words:
+            if char:
+                for c in w:
+                    if c in vocab:
+                        vocab[c] += 1
+                    else:
+                        vocab[c] = 1
+            else:
+                word = w.translate(None, _PUNCT)
+                if word in vocab:
+                    vocab[word] += 1
+                else:
+                    vocab[word] = 1
+    return vocab
+
+
 def create_vocab(text_fname, num_train, max_vocabulary_size, freq_thresh, char=False):
-    vocab = {}
     w2i = {}
     i2w = {}
     with open(text_fname,"rb") as in_f:
-        for i, line in enumerate(in_f):
-            if i >= num_train:
-                break
-            
-            words = line.strip().split()
-            for w in words:
-                if char:
-                    for c in w:
-                        if c in vocab:
-                            vocab[c] += 1
-                        else:
-                            vocab[c] = 1
-                else:
-                    word = _DIGIT_RE.sub(b"0", w)
-                    word = _WORD_SPLIT.sub(b"", w)
-                    if word in vocab:
-                        vocab[word] += 1
-                    else:
-                        vocab[word] = 1
+        vocab = count_tokens(itertools.islice(in_f, num_train), char)
 
     print("vocab length before: {0:d}".format(len(vocab)))
     vocab = {k:vocab[k] for k in vocab if vocab[k] > freq_thresh}
@@ -150,6 +260,8 @@ def create_input_config(k, num_train=NUM_TRAINING_SENTENCES, freq_thresh=FREQ_TH
     # Output file names
     if not os.path.exists(input_dir):
         os.makedirs(input_dir)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
         
     en_name = os.path.join(input_dir, "text.en")
     fr_name = os.path.join(input_dir, "text.fr")
@@ -160,39 +272,148 @@ def create_input_config(k, num_train=NUM_TRAINING_SENTENCES, freq_thresh=FREQ_TH
     vocab_path = os.path.join(input_dir, "vocab.dict")
     w2i_path = os.path.join(input_dir, "w2i.dict")
     i2w_path = os.path.join(input_dir, "i2w.dict")
-    
+
+    raw_digest = {lang: file_digest(data_fname[lang]) for lang in ("fr", "en")}
+    morf_key = morfessor_key(raw_digest["fr"]) if DATASET == 'MORFESSOR' else None
+    tokens_key = stage_key("tokens", raw_digest, DATASET, k, morf_key, TOKENIZER_VERSION)
+    vocab_key = stage_key("vocab", tokens_key, char, num_train, freq_thresh, max_vocab_size)
+
     # extract k lines
-    extract_k_lines(fr_name, en_name, k)
-    
-    # create vocabularies
-    vocab = {"en":{}, "fr":{}}
-    w2i = {"en":{}, "fr":{}}
-    i2w = {"en":{}, "fr":{}}
-    
-    print("*"*50)
-    print("en file")
-    print("*"*50)
-    vocab["en"], w2i["en"], i2w["en"] = create_vocab(en_name, 
-                                                     num_train=NUM_TRAINING_SENTENCES,
-                                                     max_vocabulary_size=max_vocab_size["en"], 
-                                                     freq_thresh=FREQ_THRESH, char=char)
-    print("*"*50)
-    print("fr file")
-    print("*"*50)
-    vocab["fr"], w2i["fr"], i2w["fr"] = create_vocab(fr_name, 
-                                                     num_train=NUM_TRAINING_SENTENCES,
-                                                     max_vocabulary_size=max_vocab_size["fr"], 
-                                                     freq_thresh=FREQ_THRESH, char=char)
-    print("*"*50)
-    
-    pickle.dump(vocab, open(vocab_path, "wb"))
-    pickle.dump(w2i, open(w2i_path, "wb"))
-    pickle.dump(i2w, open(i2w_path, "wb"))
+    text_cache = {lang: cache_fname("text", tokens_key, "." + lang) for lang in ("fr", "en")}
+    if all(os.path.exists(fname) for fname in text_cache.values()):
+        print("using cached tokenized text: {0:s}".format(text_cache["fr"]))
+    else:
+        if morf_key:
+            load_morfessor(morf_key)
+        extract_k_lines(text_cache["fr"] + ".tmp", text_cache["en"] + ".tmp", k)
+        for fname in text_cache.values():
+            os.replace(fname + ".tmp", fname)
+    if load_appended_ranges(appended_ranges_fname):
+        # text.* is rebuilt from the original corpus without the appended
+        # lines, so their ranges and the buckets holding them are stale
+        print("dropping appended data: {0:s}".format(appended_ranges_fname))
+        save_appended_ranges(appended_ranges_fname, [])
+        if os.path.exists(bucket_manifest_fname):
+            os.remove(bucket_manifest_fname)
+    publish(text_cache["fr"], fr_name)
+    publish(text_cache["en"], en_name)
+    # line offset index for random access into the corpus
+    load_line_index(fr_name)
+    load_line_index(en_name)
+
+    vocab_cache = {name: cache_fname(name, vocab_key, ".dict") for name in ("vocab", "w2i", "i2w")}
+    if all(os.path.exists(fname) for fname in vocab_cache.values()):
+        print("using cached vocabulary: {0:s}".format(vocab_cache["vocab"]))
+    else:
+        # create vocabularies
+        vocab = {"en":{}, "fr":{}}
+        w2i = {"en":{}, "fr":{}}
+        i2w = {"en":{}, "fr":{}}
+
+        print("*"*50)
+        print("en file")
+        print("*"*50)
+        vocab["en"], w2i["en"], i2w["en"] = create_vocab(en_name,
+                                                         num_train=num_train,
+                                                         max_vocabulary_size=max_vocab_size["en"],
+                                                         freq_thresh=freq_thresh, char=char)
+        print("*"*50)
+        print("fr file")
+        print("*"*50)
+        vocab["fr"], w2i["fr"], i2w["fr"] = create_vocab(fr_name,
+                                                         num_train=num_train,
+                                                         max_vocabulary_size=max_vocab_size["fr"],
+                                                         freq_thresh=freq_thresh, char=char)
+        print("*"*50)
+
+        for name, obj in (("vocab", vocab), ("w2i", w2i), ("i2w", i2w)):
+            with open(vocab_cache[name] + ".tmp", "wb") as out_f:
+                pickle.dump(obj, out_f)
+            os.replace(vocab_cache[name] + ".tmp", vocab_cache[name])
+    publish(vocab_cache["vocab"], vocab_path)
+    publish(vocab_cache["w2i"], w2i_path)
+    publish(vocab_cache["i2w"], i2w_path)
     print("finished creating input config for {0:d} lines".format(k))
 
 # In[ ]:
 
-create_input_config(k=NUM_SENTENCES, num_train=NUM_TRAINING_SENTENCES, freq_thresh=FREQ_THRESH, char=CONVOLUTIONAL)
+def update_vocab(vocab, w2i, i2w, new_counts, max_vocabulary_size, freq_thresh):
+    '''
+    Add new_counts to vocab. Existing ids never change, so trained
+    embeddings stay valid; words that now pass freq_thresh get the next free
+    ids, most frequent first, while the vocabulary is below
+    max_vocabulary_size. Returns the number of new ids.
+    '''
+    for w, count in new_counts.items():
+        vocab[w] = vocab.get(w, 0) + count
+    candidates = [w for w in new_counts if w not in w2i and vocab[w] > freq_thresh]
+    candidates = sorted(candidates, key=vocab.get, reverse=True)
+    candidates = candidates[:max(0, max_vocabulary_size - len(i2w))]
+    for w in candidates:
+        w2i[w] = len(i2w)
+        i2w[len(i2w)] = w
+    return len(candidates)
+
+
+def append_input_config(new_fname, freq_thresh=FREQ_THRESH, char=False):
+    '''
+    Append the raw parallel files new_fname (dict with "fr" and "en") to
+    text.* as training data. Only the new lines are tokenized, indexed and
+    counted; the vocabularies are extended with update_vocab and the line
+    range is recorded in appended_ranges_fname, so that create_buckets only
+    buckets the new lines.
+
+    create_input_config rebuilds text.* and the vocabularies from the
+    original corpus and drops appended data.
+    '''
+    en_name = os.path.join(input_dir, "text.en")
+    fr_name = os.path.join(input_dir, "text.fr")
+
+    if DATASET == 'MORFESSOR':
+        # segment with the model of the original corpus
+        load_morfessor(morfessor_key(file_digest(data_fname["fr"])))
+    new_text = {"fr": fr_name + ".new", "en": en_name + ".new"}
+    num_new = extract_k_lines(new_text["fr"], new_text["en"], float("inf"), src_fname=new_fname)
+
+    start = len(load_line_index(fr_name)) - 1
+    for lang, name in (("fr", fr_name), ("en", en_name)):
+        with open(name, "ab") as out_f, open(new_text[lang], "rb") as in_f:
+            shutil.copyfileobj(in_f, out_f)
+        extend_line_index(name)
+
+    with open(vocab_path, "rb") as in_f:
+        vocab = pickle.load(in_f)
+    with open(w2i_path, "rb") as in_f:
+        w2i = pickle.load(in_f)
+    with open(i2w_path, "rb") as in_f:
+        i2w = pickle.load(in_f)
+    for lang in ("fr", "en"):
+        with open(new_text[lang], "rb") as in_f:
+            new_counts = count_tokens(in_f, char)
+        num_ids = update_vocab(vocab[lang], w2i[lang], i2w[lang], new_counts,
+                               max_vocab_size[lang], freq_thresh)
+        print("{0:s}: {1:d} new ids, vocab size={2:d}".format(lang, num_ids, len(i2w[lang])))
+        os.remove(new_text[lang])
+
+    for path, obj in ((vocab_path, vocab), (w2i_path, w2i), (i2w_path, i2w)):
+        with open(path + ".tmp", "wb") as out_f:
+            pickle.dump(obj, out_f)
+        os.replace(path + ".tmp", path)
+
+    ranges = load_appended_ranges(appended_ranges_fname)
+    save_appended_ranges(appended_ranges_fname, ranges + [[start, num_new]])
+    print("appended {0:d} lines at line {1:d}".format(num_new, start))
+
+
+# In[ ]:
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        # python prepare_seq2seq.py new_data.fr new_data.en
+        append_input_config({"fr": sys.argv[1], "en": sys.argv[2]},
+                            freq_thresh=FREQ_THRESH, char=CONVOLUTIONAL)
+    else:
+        create_input_config(k=NUM_SENTENCES, num_train=NUM_TRAINING_SENTENCES, freq_thresh=FREQ_THRESH, char=CONVOLUTIONAL)
 
 
 # In[ ]: